@@ -1,25 +1,173 @@
+import argparse
+import collections
+import datetime
 import logging
+import os
 import sys
 
+from sqlalchemy import delete, func, select, text, update
+from sqlalchemy.orm import Session
+
 import tba_cache
+from tba_entities import TBAData, TBAPayload, decompress_payload, delete_unreferenced_payloads
+from tba_stats import url_pattern
+
+
+def backfill_payload_sizes(engine, batch_size=500):
+    # rows written before payload_size existed: decompress once to measure them
+    count = 0
+    with Session(engine) as session:
+        while True:
+            rows = session.execute(
+                select(TBAData.url, TBAPayload.data_json, TBAPayload.compression)
+                .join(TBAPayload, TBAData.payload_hash == TBAPayload.hash)
+                .where(TBAData.payload_size.is_(None)).limit(batch_size)).all()
+            if len(rows) == 0:
+                break
+            session.execute(update(TBAData), [
+                {'url': url, 'payload_size': len(decompress_payload(data_json, compression))}
+                for url, data_json, compression in rows])
+            session.commit()
+            count += len(rows)
+    if count > 0:
+        logging.info("measured payload size for %d rows", count)
+
+
+def stored_length():
+    return func.length(TBAPayload.data_json) + func.coalesce(func.length(TBAPayload.data_bin), 0)
+
+
+def report(engine):
+    backfill_payload_sizes(engine)
+    totals = collections.defaultdict(lambda: {'rows': 0, 'negative': 0, 'stored_bytes': 0, 'payload_bytes': 0,
+                                              'hits': 0, 'oldest': None})
+    with Session(engine) as session:
+        # stored bytes per url count a shared body in full for every url using it; the dedup line says
+        # what is actually on disk
+        rows = session.execute(select(
+            TBAData.url,
+            stored_length(),
+            TBAData.payload_size,
+            TBAData.hit_count,
+            TBAData.date,
+            TBAData.negative,
+        ).join(TBAPayload, TBAData.payload_hash == TBAPayload.hash, isouter=True))
+        for url, stored_bytes, payload_bytes, hits, date, negative in rows:
+            t = totals[url_pattern(url)]
+            t['rows'] += 1
+            t['negative'] += negative is not None
+            t['stored_bytes'] += stored_bytes or 0
+            t['payload_bytes'] += payload_bytes or 0
+            t['hits'] += hits or 0
+            if date is not None and (t['oldest'] is None or date < t['oldest']):
+                t['oldest'] = date
+
+    print(f"{'pattern':<60} {'rows':>8} {'negative':>8} {'stored':>12} {'payload':>12} {'hits':>8}  oldest")
+    for pattern, t in sorted(totals.items(), key=lambda kv: kv[1]['stored_bytes'], reverse=True):
+        oldest = '' if t['oldest'] is None else t['oldest'].strftime('%Y-%m-%d')
+        print(f"{pattern:<60} {t['rows']:>8} {t['negative']:>8} {t['stored_bytes']:>12} {t['payload_bytes']:>12} "
+              f"{t['hits']:>8}  {oldest}")
+    print(f"{'total':<60} {sum(t['rows'] for t in totals.values()):>8} "
+          f"{sum(t['negative'] for t in totals.values()):>8} "
+          f"{sum(t['stored_bytes'] for t in totals.values()):>12} "
+          f"{sum(t['payload_bytes'] for t in totals.values()):>12}")
+    dedup_report(engine)
+
+
+def dedup_report(engine):
+    with Session(engine) as session:
+        urls, distinct = session.execute(
+            select(func.count(TBAData.url), func.count(TBAData.payload_hash.distinct()))).one()
+        referenced_bytes = session.scalar(
+            select(func.sum(stored_length())).join(TBAData, TBAData.payload_hash == TBAPayload.hash)) or 0
+        payload_bytes = session.scalar(select(func.sum(stored_length())).where(
+            TBAPayload.hash.in_(select(TBAData.payload_hash)))) or 0
+        payloads = session.scalar(select(func.count(TBAPayload.hash)))
+    print(f"dedup: {urls} urls share {distinct} distinct payloads; {referenced_bytes} bytes stored as "
+          f"{payload_bytes} ({referenced_bytes / max(payload_bytes, 1):.2f}x)")
+    if payloads > distinct:
+        print(f"{payloads - distinct} payloads no url points at (--vacuum removes them)")
+
+
+def urls_to_evict(engine, prefixes=(), patterns=(), older_than_days=None, keep=None, negative=False):
+    urls = set()
+    with Session(engine) as session:
+        for prefix in prefixes:
+            urls.update(session.scalars(
+                select(TBAData.url).where(TBAData.url >= prefix, TBAData.url < prefix + '\U0010ffff')))
+        if len(patterns) > 0:
+            urls.update(url for url in session.scalars(select(TBAData.url))
+                        if url_pattern(url) in patterns)
+        if older_than_days is not None:
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than_days)
+            urls.update(session.scalars(select(TBAData.url).where(TBAData.date < cutoff)))
+        if negative:
+            urls.update(session.scalars(select(TBAData.url).where(TBAData.negative.is_not(None))))
+        if keep is not None:
+            # least recently used first; never-read rows count as used when they were fetched
+            last_used = func.coalesce(TBAData.last_access, TBAData.date)
+            urls.update(session.scalars(
+                select(TBAData.url).order_by(last_used.desc()).offset(keep)))
+    return sorted(urls)
+
+
+def evict(engine, urls, batch_size=500):
+    with Session(engine) as session:
+        for i in range(0, len(urls), batch_size):
+            session.execute(delete(TBAData).where(TBAData.url.in_(urls[i:i + batch_size])))
+        session.commit()
+
+
+def delete_unused_payloads(engine):
+    with Session(engine) as session:
+        count = delete_unreferenced_payloads(session)
+        session.commit()
+    if count > 0:
+        logging.info("deleted %d payloads no url uses any more", count)
+
+
+def vacuum(engine, db_file_name):
+    with engine.connect() as connection:
+        connection.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+        size_before = os.path.getsize(db_file_name)
+        connection.execute(text('VACUUM'))
+        connection.execute(text('ANALYZE'))
+        connection.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+    logging.info("vacuumed %s: %d -> %d bytes", db_file_name, size_before, os.path.getsize(db_file_name))
+
 
 def main(argv):
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
-    with tba_cache.TBACache() as tba:
-        cache = tba.cache
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="database file", default='tba.db')
+    parser.add_argument("--report", action='store_true', help="row counts and sizes per url pattern")
+    parser.add_argument("--evict-prefix", action='append', default=[], help="evict urls starting with this")
+    parser.add_argument("--evict-pattern", action='append', default=[],
+                        help="evict urls matching this pattern, e.g. /api/v3/district/{district}/teams/simple")
+    parser.add_argument("--older-than", type=float, help="evict rows fetched more than this many days ago")
+    parser.add_argument("--keep", type=int, help="evict least recently used rows beyond this many")
+    parser.add_argument("--evict-negative", action='store_true', help="evict remembered 404s and null payloads")
+    parser.add_argument("--dry-run", action='store_true', help="list what would be evicted")
+    parser.add_argument("--vacuum", action='store_true', help="VACUUM and ANALYZE, even if nothing was evicted")
+    args = parser.parse_args(argv)
+
+    with tba_cache.TBACache(offline=True, db_file_name=args.db) as tba:
+        urls = urls_to_evict(tba.engine, prefixes=args.evict_prefix, patterns=args.evict_pattern,
+                             older_than_days=args.older_than, keep=args.keep, negative=args.evict_negative)
+        if len(urls) > 0:
+            for url in urls:
+                logging.info("%s %s", "would evict" if args.dry_run else "evicting", url)
+            if not args.dry_run:
+                evict(tba.engine, urls)
+                logging.info("evicted %d rows", len(urls))
 
-        dirty = False
-        to_delete = []
-        for k, v in cache.items():
-            if k.endswith('/teams/simple'):
-                logging.info("deleting %s", k)
-                to_delete.append(k)
-        for k in to_delete:
-            dirty = True
-            del cache[k]
-        tba.cache_is_dirty = dirty
+        if not args.dry_run and (args.vacuum or len(urls) > 0):
+            delete_unused_payloads(tba.engine)
+            vacuum(tba.engine, args.db)
+
+        if args.report or len(urls) == 0 and not args.vacuum:
+            report(tba.engine)
 
 
 if __name__ == '__main__':
     main(sys.argv[1:])
-
@@ -22,6 +22,8 @@ def main(argv):
     logging.info ("invoked with %s", args)
 
     with tba_cache.TBACache(offline=args.offline, lazy=args.lazy) as tba:
+        # only the scores are needed, not the rest of the score breakdown
+        tba.register_projection(r'/event/[^/]+/matches$', keep=['key', 'comp_level', 'score_breakdown.*.totalPoints'])
         matches = tba.get_matches_for_event(event_key=args.event)
         all_scores = {}
         for match in matches:
@@ -15,9 +15,7 @@ def process(tba, main_event_key=None, load_avatars=False):
     year = main_event['year']
 
     teams = copy.deepcopy(tba.get_teams_at_event(main_event_key))
-    for team in teams:
-        team_key = team['key']
-        tba.make_avatar(team_key=team_key, year=year)
+    tba.export_avatars([team['key'] for team in teams], year)
 
 
 def main(argv):
@@ -48,8 +48,8 @@ def process(tba, year=None):
 
     division_events = []
     cmp_event = None
-    all_events = tba.get_events_simple(year)
-    for event in all_events:
+    # streamed: only the championship events are kept, not the whole season's list
+    for event in tba.iter_events_simple(year):
         event_type = event.get('event_type', None)
         if event_type == 3:
             division_events.append(event)
@@ -197,6 +197,7 @@ def main(argv):
     parser.add_argument("--event", help="event key", required=True)
     parser.add_argument("--offline", action='store_true', help="don't go to internet")
     parser.add_argument("--lazy", action='store_true', help="only go to internet if not in cache")
+    parser.add_argument("--swr", action='store_true', help="use stale cached data now, refresh it in the background")
 
     parser.add_argument("--default-stats", action=argparse.BooleanOptionalAction)
     parser.add_argument("--offensive", action="append")
@@ -204,7 +205,7 @@ def main(argv):
     args = parser.parse_args(argv)
     logging.info("args = %s", args)
 
-    with tba_cache.TBACache(offline=args.offline, lazy=args.lazy) as tba:
+    with tba_cache.TBACache(offline=args.offline, lazy=args.lazy, swr=args.swr) as tba:
         event = tba.get_event(args.event)
         year = int(event['year'])
         teams = copy.deepcopy(tba.get_teams_at_event(args.event))
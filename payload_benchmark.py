@@ -0,0 +1,62 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from tba_entities import BINARY_ENCODINGS, TBAData, TBAPayload, binary_version_tag, compress_payload, decompress_payload
+
+
+def time_reads(payloads, loads, repeat):
+    # best of `repeat` passes over every payload, in ms
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for payload, compression in payloads:
+            loads(decompress_payload(payload, compression))
+        elapsed = (time.perf_counter() - t0) * 1000.0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="database file", default='tba.db')
+    parser.add_argument("--prefix", help="only benchmark urls starting with this", default='/api/v3/')
+    parser.add_argument("--limit", type=int, help="number of rows to read", default=1000)
+    parser.add_argument("--repeat", type=int, help="passes per read path", default=3)
+    args = parser.parse_args(argv)
+
+    engine = create_engine(f'sqlite:///{args.db}')
+    with Session(engine) as session:
+        # each distinct body once, however many urls share it
+        rows = session.scalars(
+            select(TBAPayload).where(TBAPayload.hash.in_(
+                select(TBAData.payload_hash).where(TBAData.url.startswith(args.prefix, autoescape=True))
+            )).limit(args.limit)
+        ).all()
+        json_payloads = [(row.data_json, row.compression) for row in rows]
+        parsed = [row.data for row in rows]
+        compressions = [row.compression for row in rows]
+
+    logging.info("benchmarking %d payloads, %d bytes stored as json", len(rows),
+                 sum(len(payload) for payload, _ in json_payloads))
+
+    results = {'json': time_reads(json_payloads, json.loads, args.repeat)}
+    for encoding in sorted({tag.partition(':')[0] for tag in BINARY_ENCODINGS.keys()}):
+        dumps, loads = BINARY_ENCODINGS[binary_version_tag(encoding)]
+        bin_payloads = [(compress_payload(dumps(o), c), c) for o, c in zip(parsed, compressions)]
+        logging.info("%s: %d bytes stored", encoding, sum(len(payload) for payload, _ in bin_payloads))
+        results[encoding] = time_reads(bin_payloads, loads, args.repeat)
+
+    for name, ms in results.items():
+        logging.info("%-8s %9.2f ms total, %7.3f ms per payload, %5.2fx json", name, ms,
+                     ms / max(len(rows), 1), results['json'] / ms if ms > 0 else 0.0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
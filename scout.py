@@ -66,6 +66,22 @@ def process(tba, main_event_key=None):
     competition_results = {}  # keyed by event_key
     teams = copy.deepcopy(tba.get_teams_at_event(main_event_key))
     teams.sort(key=lambda team: team['team_number'])
+
+    # warm the cache in bulk instead of one url at a time inside the loops below
+    urls = tba_cache.TBAUrlCollector()
+    for team in teams:
+        urls.get_events_for_team(team['key'], year)
+    tba.prefetch_many(urls.urls)
+
+    urls = tba_cache.TBAUrlCollector()
+    for team in teams:
+        for event in tba.get_events_for_team(team['key'], year):
+            if event['start_date'] < start_date:
+                urls.get_teams_at_event(event['key'])
+                urls.get_matches_for_event(event_key=event['key'])
+                urls.get_team_statuses_at_event(event['key'])
+    tba.prefetch_many(urls.urls)
+
     for team in teams:
         team_key = team['key']
 
@@ -179,11 +195,12 @@ def main(argv):
     parser.add_argument("--event", help="event key", required=True)
     parser.add_argument("--offline", action='store_true', help="don't go to internet")
     parser.add_argument("--lazy", action='store_true', help="only go to internet if not in cache")
+    parser.add_argument("--swr", action='store_true', help="use stale cached data now, refresh it in the background")
     args = parser.parse_args(argv)
 
     logging.info ("invoked with %s", args)
 
-    with tba_cache.TBACache(offline=args.offline, lazy=args.lazy) as tba:
+    with tba_cache.TBACache(offline=args.offline, lazy=args.lazy, swr=args.swr) as tba:
         teams = process(tba, args.event)
 
     field_names = OrderedDict()
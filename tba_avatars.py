@@ -0,0 +1,94 @@
+import base64
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# file name -> {'team_key', 'year', 'sha1', 'size'} for every avatar written to the directory
+MANIFEST = 'manifest.json'
+
+
+def read_manifest(directory='avatars'):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    # files deleted since the manifest was written don't count
+    present = set(os.listdir(directory))
+    return {file_name: entry for file_name, entry in manifest.items() if file_name in present}
+
+
+def write_manifest(manifest, directory='avatars'):
+    # write then rename, so a reader never sees half a manifest
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def avatar_file(team_key, year, manifest, directory='avatars'):
+    # the avatar's path if there is one. the manifest only saves looking: files it doesn't list (written
+    # before it existed, or by hand) are still found on disk
+    file_name = f'avatar_{year}_{team_key}.png'
+    path = f'{directory}/{file_name}'
+    if file_name in manifest:
+        return path
+    return path if os.path.isfile(path) else None
+
+
+def write_avatar(path, b64, known):
+    # returns (sha1, size, written); the file is only rewritten if its content changed
+    content = base64.b64decode(b64)
+    sha1 = hashlib.sha1(content).hexdigest()
+    try:
+        size_on_disk = os.path.getsize(path)
+    except FileNotFoundError:
+        size_on_disk = None
+    if size_on_disk == len(content):
+        if known is not None and known['sha1'] == sha1 and known['size'] == len(content):
+            return sha1, len(content), False
+        with open(path, 'rb') as f:
+            if hashlib.sha1(f.read()).hexdigest() == sha1:
+                return sha1, len(content), False
+    with open(path + '.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+    return sha1, len(content), True
+
+
+def write_avatars(media_by_team, year, directory='avatars', max_workers=8):
+    # media_by_team: team key -> its media list for year. returns team key -> avatar path
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    jobs = {}
+    for team_key, media_list in media_by_team.items():
+        for media in media_list or []:
+            if media['type'] != 'avatar':
+                continue
+            b64 = media.get('details', {}).get('base64Image', None)
+            if b64 is not None:
+                jobs[team_key] = (media['foreign_key'] + '.png', b64)
+
+    paths = {}
+    written = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(write_avatar, f'{directory}/{file_name}', b64, manifest.get(file_name, None)):
+                (team_key, file_name)
+            for team_key, (file_name, b64) in jobs.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            team_key, file_name = futures[future]
+            sha1, size, changed = future.result()
+            manifest[file_name] = {'team_key': team_key, 'year': year, 'sha1': sha1, 'size': size}
+            paths[team_key] = f'{directory}/{file_name}'
+            written += changed
+
+    write_manifest(manifest, directory)
+    logger.info("avatars: %d teams, %d with avatars, %d written, %d unchanged",
+                len(media_by_team), len(paths), written, len(paths) - written)
+    return paths
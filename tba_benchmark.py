@@ -0,0 +1,244 @@
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+import tba_cache
+import tba_standin
+from tba_entities import TBAData, migrate_schema, new_payload
+
+logger = logging.getLogger(__name__)
+
+MODES = ['cold_network', 'cold_prefetch', 'revalidate_304', 'lazy_sqlite', 'offline_sqlite', 'memory']
+
+
+def synthetic_match(event_key, i, rng):
+    # shaped like a real /matches element: alliances, a wide score_breakdown per color, videos
+    breakdown = {color: {f'metric{m}': rng.randint(0, 50) for m in range(60)} for color in ('red', 'blue')}
+    for color in ('red', 'blue'):
+        breakdown[color]['totalPoints'] = sum(breakdown[color].values())
+        breakdown[color]['foulPoints'] = rng.randint(0, 20)
+    return {
+        'key': f'{event_key}_qm{i}',
+        'event_key': event_key,
+        'comp_level': 'qm',
+        'match_number': i,
+        'set_number': 1,
+        'actual_time': 1700000000 + i * 420,
+        'alliances': {
+            color: {
+                'score': breakdown[color]['totalPoints'],
+                'team_keys': [f'frc{rng.randint(1, 9999)}' for _ in range(3)],
+                'surrogate_team_keys': [],
+                'dq_team_keys': [],
+            } for color in ('red', 'blue')
+        },
+        'score_breakdown': breakdown,
+        'videos': [{'type': 'youtube', 'key': hashlib.md5(f'{event_key}{i}'.encode()).hexdigest()[:11]}],
+    }
+
+
+def synthetic_corpus(url_count, seed=3620):
+    # (url, payload) pairs: a mix of big match lists and the small payloads around them
+    rng = random.Random(seed)
+    corpus = []
+    event_index = 0
+    while len(corpus) < url_count:
+        event_key = f'2025bench{event_index}'
+        event_index += 1
+        teams = [{'key': f'frc{n}', 'team_number': n, 'nickname': f'Team {n}'}
+                 for n in rng.sample(range(1, 9999), 40)]
+        corpus.append((f'/api/v3/event/{event_key}/matches',
+                       [synthetic_match(event_key, i, rng) for i in range(1, 81)]))
+        corpus.append((f'/api/v3/event/{event_key}/teams', teams))
+        corpus.append((f'/api/v3/event/{event_key}', {'key': event_key, 'year': 2025, 'event_type': 1}))
+        for team in teams:
+            corpus.append((f'/api/v3/team/{team["key"]}/event/{event_key}/status',
+                           {'overall_status_str': f'{team["key"]} was ranked {rng.randint(1, 40)}'}))
+    return corpus[:url_count]
+
+
+def write_corpus(db_file_name, corpus):
+    engine = create_engine(f'sqlite:///{db_file_name}')
+    migrate_schema(engine)
+    with Session(engine) as session:
+        for url, payload in corpus:
+            body = json.dumps(payload).encode('utf-8')
+            payload = session.merge(new_payload(body, 'zlib'))
+            session.merge(TBAData(url=url, etag='W/"' + hashlib.sha1(body).hexdigest() + '"',
+                                  date=datetime.datetime.now(), payload_hash=payload.hash, payload_size=len(body)))
+        session.commit()
+    engine.dispose()
+
+
+def replayed_urls(db_file_name, url_count):
+    engine = create_engine(f'sqlite:///{db_file_name}')
+    with Session(engine) as session:
+        urls = list(session.scalars(select(TBAData.url).order_by(TBAData.url).limit(url_count)))
+    engine.dispose()
+    return urls
+
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))]
+
+
+def run_fetches(cache, urls):
+    latencies = []
+    t0 = time.perf_counter()
+    for url in urls:
+        t = time.perf_counter()
+        cache.fetch(url)
+        latencies.append((time.perf_counter() - t) * 1000.0)
+    return time.perf_counter() - t0, latencies
+
+
+def result(seconds, latencies, cache):
+    latencies = sorted(latencies)
+    return {
+        'seconds': round(seconds, 4),
+        'fetches_per_second': round(len(latencies) / seconds, 1) if seconds > 0 else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 4),
+            'p90': round(percentile(latencies, 90), 4),
+            'p99': round(percentile(latencies, 99), 4),
+            'max': round(latencies[-1], 4) if len(latencies) > 0 else 0.0,
+        },
+        'fetch_stats': cache.stats.summary(),
+    }
+
+
+def benchmark(urls, server, cache_db, modes, concurrency):
+    results = {}
+    options = {'db_file_name': cache_db, 'base_url': server.base_url, 'memory_max_bytes': None}
+
+    # served with max-age=0, so rows stored by the cold runs are immediately due for revalidation
+    server.max_age = 0
+    warm = False
+    for mode in modes:
+        if mode in ('cold_network', 'cold_prefetch'):
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(cache_db + suffix):
+                    os.remove(cache_db + suffix)
+            warm = True
+        elif not warm:
+            # the warm modes were asked for without a cold run first: fill the cache, untimed
+            with tba_cache.TBACache(write_behind=True, **options) as cache:
+                cache.prefetch_many(urls, max_concurrency=concurrency)
+            warm = True
+
+        if mode == 'cold_prefetch':
+            with tba_cache.TBACache(write_behind=True, **options) as cache:
+                t0 = time.perf_counter()
+                cache.prefetch_many(urls, max_concurrency=concurrency)
+                seconds, latencies = run_fetches(cache, urls)
+                results[mode] = result(time.perf_counter() - t0, latencies, cache)
+        elif mode == 'memory':
+            with tba_cache.TBACache(offline=True, **options) as cache:
+                run_fetches(cache, urls)
+                # a pass is only milliseconds long, so keep the best of several
+                best = None
+                for _ in range(5):
+                    cache.stats = tba_cache.FetchStats()
+                    seconds, latencies = run_fetches(cache, urls)
+                    if best is None or seconds < best[0]:
+                        best = (seconds, latencies)
+                results[mode] = result(best[0], best[1], cache)
+        else:
+            with tba_cache.TBACache(lazy=(mode == 'lazy_sqlite'), offline=(mode == 'offline_sqlite'),
+                                    **options) as cache:
+                seconds, latencies = run_fetches(cache, urls)
+                results[mode] = result(seconds, latencies, cache)
+        logger.info("%-15s %8.3fs %10s fetches/s  p50 %.3f ms  p99 %.3f ms", mode, results[mode]['seconds'],
+                    results[mode]['fetches_per_second'], results[mode]['latency_ms']['p50'],
+                    results[mode]['latency_ms']['p99'])
+    return results
+
+
+def compare(results, previous, threshold):
+    # returns the modes whose throughput dropped by more than threshold (a fraction)
+    regressions = []
+    for mode, r in results.items():
+        before = previous.get('results', {}).get(mode, None)
+        if before is None or not before.get('fetches_per_second') or not r['fetches_per_second']:
+            continue
+        ratio = r['fetches_per_second'] / before['fetches_per_second']
+        logger.info("%-15s %.2fx previous throughput", mode, ratio)
+        if ratio < 1.0 - threshold:
+            regressions.append(mode)
+    return regressions
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    logging.getLogger('tba_cache').setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--urls", type=int, default=2000, help="number of urls in the corpus")
+    parser.add_argument("--corpus-db", help="replay urls from this tba.db instead of a synthetic corpus")
+    parser.add_argument("--mode", action='append', choices=MODES, help="modes to run (default: all)")
+    parser.add_argument("--latency", type=float, default=0.0, help="stand-in server latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="stand-in server jitter, seconds")
+    parser.add_argument("--concurrency", type=int, default=8, help="max_concurrency for cold_prefetch")
+    parser.add_argument("--output", help="json results file", default='tba_benchmark.json')
+    parser.add_argument("--compare", help="previous results file to compare throughput against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="throughput drop vs --compare that counts as a regression")
+    args = parser.parse_args(argv)
+
+    modes = args.mode or MODES
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.corpus_db is not None:
+            corpus_db = args.corpus_db
+            urls = replayed_urls(corpus_db, args.urls)
+        else:
+            corpus_db = os.path.join(work_dir, 'corpus.db')
+            corpus = synthetic_corpus(args.urls)
+            write_corpus(corpus_db, corpus)
+            urls = [url for url, _ in corpus]
+        logger.info("corpus: %d urls from %s", len(urls), corpus_db)
+
+        server = tba_standin.StandinServer(db_file_name=corpus_db, port=0, latency=args.latency,
+                                           jitter=args.jitter).start()
+        try:
+            results = benchmark(urls, server, os.path.join(work_dir, 'cache.db'), modes, args.concurrency)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    output = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'urls': len(urls),
+        'corpus': args.corpus_db or 'synthetic',
+        'latency': args.latency,
+        'jitter': args.jitter,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    logger.info("results written to %s", args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if len(regressions) > 0:
+            logger.warning("throughput regressions: %s", ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
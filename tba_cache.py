@@ -1,95 +1,93 @@
-import base64
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import email.utils
+import json
 import logging
+import os
+import re
+import socket
 import sys
+import threading
+import time
 
 import requests
+import urllib3
 
-from sqlalchemy import create_engine
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sqlalchemy import and_, bindparam, create_engine, delete, event, func, select, update
+from sqlalchemy.dialects.sqlite import insert
 
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 import creds
-from tba_entities import TBAData
-
-
-class TBACache:
-
-    def __init__(self, offline=False, lazy=False, db_file_name='tba.db', echo=False):
-        self.logger = logging.getLogger(__name__)
-        self.db_file_name = db_file_name
-        self.already_fetched : dict[str,TBAData] = {}
-        self.offline = offline
-        self.lazy = lazy
-        self.engine = create_engine(f'sqlite:///{db_file_name}', echo=echo)
-        self.session = None
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, exc_tb):
-        return False
+from tba_avatars import write_avatars
+from tba_entities import BINARY_ENCODINGS, TBAData, TBAFetchLock, TBAPayload, delete_unreferenced_payloads, \
+    migrate_schema, new_payload
+from tba_ingest import ingest
+from tba_memory import MemoryTier
+from tba_projection import Projection
+from tba_scheduler import BULK, INTERACTIVE, PRIORITY_NAMES, RequestScheduler, retry_after_seconds
+from tba_stats import FetchStats
+
+
+def freshness_lifetime(headers):
+    # seconds the response may be served without revalidation, per Cache-Control or Expires
+    cache_control = headers.get('Cache-Control', '')
+    for directive in cache_control.split(','):
+        name, _, value = directive.strip().partition('=')
+        name = name.lower()
+        if name in ('no-cache', 'no-store'):
+            return 0
+        if name == 'max-age':
+            try:
+                return max(0, int(value.strip('"')) - int(headers.get('Age', 0)))
+            except ValueError:
+                return 0
+
+    expires = headers.get('Expires', None)
+    if expires is not None:
+        try:
+            expires_at = email.utils.parsedate_to_datetime(expires)
+            date = headers.get('Date', None)
+            now = email.utils.parsedate_to_datetime(date) if date is not None \
+                else datetime.datetime.now(datetime.timezone.utc)
+            return max(0, int((expires_at - now).total_seconds()))
+        except (TypeError, ValueError):
+            return 0
+
+    return 0
+
+
+def wire_size(response):
+    # bytes that came over the network, before any Content-Encoding was undone
+    try:
+        size = response.raw.tell()
+    except (AttributeError, OSError):
+        size = 0
+    if size > 0 or len(response.content or b'') == 0:
+        return size
+    length = response.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else len(response.content)
+
+
+def past_season_overrides(current_year=None):
+    # anything keyed by an earlier season (events, district, team/.../events/{year}, media/{year})
+    # will not change any more, so it never needs revalidating. only earlier ones: next season's
+    # schedule is published before it starts, and keeps changing
+    if current_year is None:
+        current_year = datetime.date.today().year
+    past_years = '|'.join(str(year) for year in range(1992, current_year))
+    return [(rf'/({past_years})([a-z]|/|$)', None)]
+
+
+class TBAEndpoints:
+    # url builders for the TBA v3 api; subclasses decide what fetch() does with the url
 
     def fetch(self, url=None):
-        cache_entry = self.already_fetched.get(url, None)
-
-        if cache_entry is not None:
-            return cache_entry.data
-
-        if self.session is None:
-            self.session = sessionmaker(bind=self.engine)()
-
-        existing_tba_data = self.session.get(TBAData, url)
-        etag = None
-        if existing_tba_data is not None:
-            if self.offline or self.lazy:
-                return existing_tba_data.data
-            etag = existing_tba_data.etag
-        else:
-            if self.offline:
-                # offline and missing
-                self.logger.warning("%s not in cache", url)
-                return None
-
-        # need to fetch
-        headers = {
-            'X-TBA-Auth-Key': creds.tba_auth_key,
-            'accept': 'application/json',
-        }
-        if etag is not None:
-            headers['If-None-Match'] = etag
-
-        response = requests.get('https://www.thebluealliance.com' + url, headers=headers)
-
-        self.logger.info("got a %d for %s", response.status_code, url)
-
-        # throw exception for a 4xx or 5xx
-        response.raise_for_status()
-
-        # check for other catastrophic codes here
-
-        # and we are good!
-
-        if response.status_code == 304:
-            return existing_tba_data.data
-
-        tba_data = TBAData(
-            url=url,
-            etag=response.headers['etag'],
-            date=datetime.datetime.now().astimezone(),
-            data_json=response.content
-        )
-        self.already_fetched[url] = tba_data
-        if existing_tba_data is not None:
-            self.session.delete(existing_tba_data)
-
-        self.session.add(tba_data)
-        self.session.commit()
-
-        return tba_data.data
-
-    def done(self):
-        pass
+        raise NotImplementedError
 
     def get_teams_at_event(self, event_key=None):
         return self.fetch(f"/api/v3/event/{event_key}/teams")
@@ -103,6 +101,12 @@ class TBACache:
     def get_matches_for_event(self, event_key=None):
         return self.fetch(f"/api/v3/event/{event_key}/matches")
 
+    def get_event_awards(self, event_key=None):
+        return self.fetch(f"/api/v3/event/{event_key}/awards")
+
+    def get_event_rankings(self, event_key=None):
+        return self.fetch(f"/api/v3/event/{event_key}/rankings")
+
     def get_event_keys_for_team(self, team_key=None, year=None):
         if year is None:
             return self.fetch(f"/api/v3/team/{team_key}/events/keys")
@@ -155,18 +159,787 @@ class TBACache:
         else:
             return self.fetch(f"/api/v3/team/{team_key}/events/{year}")
 
+    def get_teams_page(self, page=0, year=None, simple=False):
+        # 500 teams to a page, in team number order; past the last page the list is empty
+        suffix = '/simple' if simple else ''
+        if year is None:
+            return self.fetch(f"/api/v3/teams/{page}{suffix}")
+        else:
+            return self.fetch(f"/api/v3/teams/{year}/{page}{suffix}")
+
+
+class TBAUrlCollector(TBAEndpoints):
+    # records the urls the get_* helpers would fetch, so they can be handed to TBACache.prefetch_many
+
+    def __init__(self):
+        self.urls = []
+
+    def fetch(self, url=None):
+        self.urls.append(url)
+        return None
+
+
+class TBACache(TBAEndpoints):
+
+    def __init__(self, offline=False, lazy=False, db_file_name='tba.db', echo=False,
+                 pool_size=10, max_retries=5, backoff_factor=0.5, freshness_overrides=None,
+                 write_behind=False, commit_rows=500, commit_ms=1000, compression='zlib',
+                 binary_encoding=None, memory_max_entries=None, memory_max_bytes=64 * 1024 * 1024,
+                 busy_timeout=30, single_flight=True, fetch_lock_seconds=30,
+                 stats_file=None, stats_log_every=None, base_url='https://www.thebluealliance.com',
+                 normalize=False, rate_limit=None, rate_burst=10, max_in_flight=None, swr=False, swr_workers=4,
+                 negative_ttl=6 * 3600):
+        self.logger = logging.getLogger(__name__)
+        self.db_file_name = db_file_name
+        # every hit path (network, 304, fresh, lazy, offline) feeds this, so a url touches SQLite at most once
+        self.memory = MemoryTier(max_entries=memory_max_entries, max_bytes=memory_max_bytes)
+        self.offline = offline
+        self.lazy = lazy
+        # point this at tba_standin.py to benchmark without touching the real api
+        self.base_url = base_url.rstrip('/')
+        # other processes may be writing the same file: wait for their locks instead of failing
+        self.busy_timeout = busy_timeout
+        # a thread can hold two connections at once (its session and a fetch lock claim), so the pool
+        # may grow past pool_size rather than make threads wait for each other
+        self.engine = create_engine(f'sqlite:///{db_file_name}', echo=echo, connect_args={'timeout': busy_timeout},
+                                    pool_size=pool_size, max_overflow=-1)
+        event.listen(self.engine, 'connect', self._on_connect)
+
+        # instrumentation: a json summary is logged (and written to stats_file) on exit, and a
+        # progress line every stats_log_every fetches
+        self.stats = FetchStats()
+        self.stats_file = stats_file
+        self.stats_log_every = stats_log_every
+        event.listen(self.engine, 'before_cursor_execute', self._before_sql)
+        event.listen(self.engine, 'after_cursor_execute', self._after_sql)
+        migrate_schema(self.engine)
+        # one session per thread, closed after every lookup so pool threads don't each hold a connection:
+        # what it loaded lives on detached (in the memory tier, possibly used by other threads), and
+        # changes are only ever written by flush()
+        self.session_factory = sessionmaker(bind=self.engine, expire_on_commit=False, autoflush=False)
+        self.Session = scoped_session(self.session_factory)
+
+        # the instance can be shared by a thread pool: the pending_* state is guarded by lock, flushes
+        # run one at a time, and threads asking for the same url wait for the one fetching it
+        self.lock = threading.Lock()
+        self.flush_lock = threading.RLock()
+        self.in_flight: dict[str, concurrent.futures.Future] = {}
+
+        # stale-while-revalidate: a stale row is returned as is, and revalidated with its etag on a
+        # background worker (at bulk priority); the next fetch() sees the result. done() waits for them
+        self.swr = swr
+        self.swr_workers = swr_workers
+        self.revalidator = None
+        self.revalidating = set()
+
+        # write-behind: rows are upserted in batches of commit_rows, or after commit_ms, or on done().
+        # a timer holds the commit_ms deadline when no further row comes along to check it
+        self.write_behind = write_behind
+        self.commit_rows = commit_rows
+        self.commit_ms = commit_ms
+        self.flush_timer = None
+        self.pending_writes = []
+        self.pending_payloads = []
+        self.pending_releases = []
+        self.flushing = []
+        self.pending_access: dict[str, int] = {}
+        self.last_commit = time.monotonic()
+
+        # normalize: new payloads also fill the entity tables (tba_ingest.py), in the same transaction
+        self.normalize = normalize
+        self.pending_ingest = []
+
+        # single-flight across processes sharing the db: the first to claim a url in tba_fetch_lock
+        # fetches it, the others wait for the row it writes
+        self.single_flight = single_flight
+        self.fetch_lock_seconds = fetch_lock_seconds
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{id(self)}'
+
+        # bodies no url points at any more (the url's payload changed), deleted on the next flush
+        self.replaced_payloads = set()
+
+        # how new payloads are stored; rows written with other settings stay readable
+        self.compression = compression
+        # 'marshal' also stores a pre-parsed copy, so later runs skip json.loads
+        self.binary_encoding = binary_encoding
+
+        # (regex, seconds) pairs checked in order before the response headers; None seconds = never stale
+        self.freshness_overrides = [(re.compile(pattern), seconds) for pattern, seconds in freshness_overrides or []]
+
+        # 404s and null bodies are remembered too, for this many seconds, so probes for data that
+        # doesn't exist aren't repeated every run (and lazy/offline runs answer them from the db)
+        self.negative_ttl = negative_ttl
+
+        # projection name -> (regex, Projection), see register_projection()
+        self.projections = {}
+
+        # every request goes through the scheduler: at most max_in_flight (default pool_size) at once,
+        # rate_limit per second if set, interactive before bulk (see bulk()), and a 429's Retry-After
+        # holds all of them rather than just the one that got it
+        self.scheduler = RequestScheduler(rate=rate_limit, burst=rate_burst,
+                                          max_in_flight=pool_size if max_in_flight is None else max_in_flight)
+        self.local = threading.local()
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+        # one keep-alive connection pool for every request, retrying server errors (429s are the scheduler's)
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=['GET'],
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.http = requests.Session()
+        self.http.mount('https://', self.adapter)
+        self.http.mount('http://', self.adapter)
+        self.http.headers.update({
+            'X-TBA-Auth-Key': creds.tba_auth_key,
+            'accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+        })
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.done()
+        self.logger.info("http connection stats: %s", self.connection_stats())
+        self.logger.info("memory tier stats: %s", self.memory.stats())
+        summary = self.stats.to_json()
+        self.logger.info("fetch stats: %s", summary)
+        if self.stats_file is not None:
+            with open(self.stats_file, 'w') as f:
+                f.write(summary)
+        self.http.close()
+        return False
+
+    @staticmethod
+    def _before_sql(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_sql(self, connection, cursor, statement, parameters, context, executemany):
+        self.stats.record_sql(time.perf_counter() - connection.info['query_start'].pop())
+
+    def connection_stats(self):
+        # urllib3 counts connections opened and requests sent per host pool; the difference is reuse
+        rv = {'connections': 0, 'requests': 0}
+        for pool_key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(pool_key)
+            if pool is not None:
+                rv['connections'] += pool.num_connections
+                rv['requests'] += pool.num_requests
+        rv['reused'] = rv['requests'] - rv['connections']
+        return rv
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        # WAL lets readers carry on while a batch is being committed, and makes commits cheaper
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    def _get_session(self):
+        return self.Session()
+
+    def register_projection(self, pattern, keep=None, drop=None):
+        # urls matching pattern are stored and returned slimmed down to the keep paths (or without the
+        # drop paths), under their own key, so the full payload is neither stored nor decoded
+        projection = Projection(keep=keep, drop=drop)
+        self.projections[projection.name] = (re.compile(pattern), projection)
+        return projection
+
+    def _cache_key(self, url):
+        for name, (pattern, projection) in self.projections.items():
+            if pattern.search(url):
+                return f'{url}#{name}'
+        return url
+
+    def fetch(self, url=None):
+        t0 = time.perf_counter()
+        tba_data, source = self._fetch_entry(self._cache_key(url))
+        data = None if tba_data is None else self._decode(tba_data)
+        self.stats.record_fetch(source, time.perf_counter() - t0)
+        if self.stats_log_every is not None and self.stats.fetches % self.stats_log_every == 0:
+            self.logger.info("fetch stats: %s", self.stats.line())
+        return data
+
+    def fetch_iter(self, url=None):
+        # like fetch(), but yields the payload's elements (or (key, value) pairs) as they are decoded,
+        # so a scan can stop early and a huge payload is never in memory all at once
+        t0 = time.perf_counter()
+        tba_data, source = self._fetch_entry(self._cache_key(url))
+        self.stats.record_fetch(source, time.perf_counter() - t0)
+        if tba_data is not None:
+            yield from tba_data.iter_data()
+
+    def iter_events_simple(self, year=None):
+        return self.fetch_iter(f"/api/v3/events/{year}/simple")
+
+    def get_all_teams(self, year=None, simple=False, max_concurrency=4):
+        # yields every team (or every team that competed in year), in page order. there is no page count,
+        # so the next max_concurrency pages are always being fetched; once a page comes back empty no
+        # page past it is requested. pages are cached like any other url, so a rerun is all 304s
+        priority = self._priority()
+
+        def fetch_page(page):
+            # the workers make their requests at the caller's priority
+            self.local.priority = priority
+            return self.get_teams_page(page, year, simple)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+        try:
+            pages = collections.deque(executor.submit(fetch_page, page) for page in range(max_concurrency))
+            next_page = max_concurrency
+            while len(pages) > 0:
+                teams = pages.popleft().result()
+                if not teams:
+                    break
+                pages.append(executor.submit(fetch_page, next_page))
+                next_page += 1
+                yield from teams
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def get_all_events(self, years, simple=True, max_concurrency=8):
+        # yields every event of the given seasons, in season order; the seasons are fetched in parallel
+        suffix = '/simple' if simple else ''
+        urls = [f"/api/v3/events/{year}{suffix}" for year in years]
+        self.prefetch_many(urls, max_concurrency=max_concurrency)
+        for url in urls:
+            yield from self.fetch(url) or []
+
+    def poll(self, url):
+        # like fetch(), but past the memory tier: revalidates once the stored row is stale.
+        # returns (data, source); source 'downloaded' means the payload changed
+        url = self._cache_key(url)
+        self.memory.discard(url)
+        t0 = time.perf_counter()
+        tba_data, source = self._fetch_entry(url)
+        data = None if tba_data is None else self._decode(tba_data)
+        self.stats.record_fetch(source, time.perf_counter() - t0)
+        return data, source
+
+    def _decode(self, tba_data):
+        payload = tba_data.payload
+        if payload is None:
+            return None
+        if payload.data_cache is not None:
+            return payload.data_cache
+        t0 = time.perf_counter()
+        data_bin = payload.data_bin
+        data = payload.data
+        self.stats.record_decode(time.perf_counter() - t0)
+        if payload.data_bin is not data_bin:
+            # a stale or unreadable binary copy was rebuilt (or dropped) on read; rows are detached, so
+            # write it back explicitly
+            self._store(tba_data, payload=payload)
+        return data
+
+    def _fetch_entry(self, url, count_access=True, priority=None):
+        # returns (TBAData or None, where it came from)
+        with self.lock:
+            if count_access:
+                self.pending_access[url] = self.pending_access.get(url, 0) + 1
+            cache_entry = self.memory.get(url)
+            if cache_entry is not None:
+                return cache_entry, 'memory'
+            in_flight = self.in_flight.get(url, None)
+            if in_flight is None:
+                future = self.in_flight[url] = concurrent.futures.Future()
+
+        if in_flight is not None:
+            # another thread is already looking this url up: share its answer (or its exception)
+            tba_data, source = in_flight.result()
+            return tba_data, 'other_thread'
+
+        try:
+            tba_data, source = self._lookup(url, priority)
+            future.set_result((tba_data, source))
+            return tba_data, source
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.Session.close()
+            with self.lock:
+                del self.in_flight[url]
+
+    def _lookup(self, url, priority=None, allow_stale=True):
+        if self.write_behind:
+            # a row we fetched may still be waiting in write-behind (or mid-flush) after dropping out of
+            # the memory tier: publish it first so it is read below, not waited on as someone else's fetch
+            with self.lock:
+                pending = url in self.pending_releases or url in self.flushing
+            if pending:
+                self.flush()
+        existing_tba_data = self._get_session().get(TBAData, url)
+        if existing_tba_data is None:
+            existing_tba_data = self._project_stored(url)
+        etag = None
+        if existing_tba_data is not None:
+            if self.offline or self.lazy or self._is_fresh(existing_tba_data):
+                self.memory.put(url, existing_tba_data)
+                return existing_tba_data, 'negative' if existing_tba_data.negative else 'sqlite'
+            if self.swr and allow_stale:
+                self.memory.put(url, existing_tba_data)
+                self._revalidate_later(url)
+                return existing_tba_data, 'stale'
+            etag = existing_tba_data.etag or None
+        else:
+            if self.offline:
+                # offline and missing
+                self.logger.warning("%s not in cache", url)
+                return None, 'missing'
+
+        # need to fetch, unless another process already is
+        claimed = self._claim(url)
+        if not claimed and self._lock_owner(url) == self.owner:
+            # our own claim, on a row still waiting in write-behind (and since dropped from the memory
+            # tier): publish it and read it back rather than wait on ourselves
+            self.flush()
+            tba_data = self._get_session().get(TBAData, url, populate_existing=True)
+            if tba_data is not None and (self.lazy or self._is_fresh(tba_data)):
+                self.memory.put(url, tba_data)
+                return tba_data, 'negative' if tba_data.negative else 'sqlite'
+            existing_tba_data = tba_data
+            etag = None if existing_tba_data is None else existing_tba_data.etag or None
+            claimed = self._claim(url)
+        if not claimed:
+            tba_data = self._wait_for_other_fetch(url, existing_tba_data)
+            if tba_data is not None:
+                self.memory.put(url, tba_data)
+                return tba_data, 'other_process'
+            existing_tba_data = self._get_session().get(TBAData, url)
+            etag = None if existing_tba_data is None else existing_tba_data.etag or None
+        elif self.single_flight:
+            # someone may have finished fetching it between our read and our claim
+            tba_data = self._get_session().get(TBAData, url, populate_existing=True)
+            if tba_data is not None and self._is_fresh(tba_data):
+                self._release(url)
+                self.memory.put(url, tba_data)
+                return tba_data, 'other_process'
+
+        try:
+            response = self._request(url, etag, priority)
+            tba_data = self._store_response(url, existing_tba_data, response)
+            return tba_data, 'revalidated' if response.status_code == 304 else 'downloaded'
+        except Exception:
+            self._release(url)
+            raise
+
+    def _project_stored(self, url):
+        # a projected url with no row of its own, but whose full payload is stored: the projection is made
+        # from that (with its etag and freshness) and stored, rather than counted as a miss
+        url_path, _, projection_name = url.partition('#')
+        if projection_name == '':
+            return None
+        full_tba_data = self._get_session().get(TBAData, url_path)
+        if full_tba_data is None:
+            return None
+        data = full_tba_data.data
+        if data is not None:
+            data = self.projections[projection_name][1].apply(data)
+        content = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        payload = new_payload(content, self.compression)
+        payload.data_cache = data
+        if self.binary_encoding is not None:
+            payload.encode_binary(self.binary_encoding)
+        tba_data = TBAData(
+            url=url,
+            etag=full_tba_data.etag,
+            date=full_tba_data.date,
+            payload_hash=payload.hash,
+            expires=full_tba_data.expires,
+            payload_size=len(content),
+            negative=full_tba_data.negative,
+        )
+        tba_data.payload = payload
+        self._store(tba_data, payload=payload)
+        return tba_data
+
+    def _revalidate_later(self, url):
+        with self.lock:
+            if url in self.revalidating:
+                return
+            self.revalidating.add(url)
+            if self.revalidator is None:
+                self.revalidator = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.swr_workers, thread_name_prefix='tba-revalidate')
+            self.revalidator.submit(self._revalidate, url)
+
+    def _revalidate(self, url):
+        try:
+            self._lookup(url, BULK, allow_stale=False)
+        except Exception as e:
+            # the stale row stays in place. out of the memory tier, so the next fetch() reads it from
+            # sqlite again and queues another revalidation
+            self.memory.discard(url)
+            self.logger.warning("background revalidation of %s failed: %s", url, e)
+        finally:
+            self.Session.close()
+            with self.lock:
+                self.revalidating.discard(url)
+
+    def _claim(self, url):
+        if not self.single_flight:
+            return True
+        now = datetime.datetime.now()
+        stmt = insert(TBAFetchLock).values(
+            url=url, owner=self.owner, expires=now + datetime.timedelta(seconds=self.fetch_lock_seconds))
+        # take the lock over only if whoever held it has given up on it
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[TBAFetchLock.url],
+            set_={'owner': stmt.excluded.owner, 'expires': stmt.excluded.expires},
+            where=TBAFetchLock.expires < now,
+        )
+        with self.engine.begin() as connection:
+            return connection.execute(stmt).rowcount == 1
+
+    def _lock_owner(self, url):
+        with self.engine.connect() as connection:
+            return connection.execute(select(TBAFetchLock.owner).where(TBAFetchLock.url == url)).scalar()
+
+    def _release(self, url):
+        if self.single_flight:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    delete(TBAFetchLock).where(TBAFetchLock.url == url, TBAFetchLock.owner == self.owner))
+
+    def _wait_for_other_fetch(self, url, existing_tba_data):
+        # returns the row the other process stored, or None if it gave up (so we fetch it ourselves)
+        before = None if existing_tba_data is None \
+            else (existing_tba_data.etag, existing_tba_data.date, existing_tba_data.expires)
+        self.logger.debug("waiting for another process to fetch %s", url)
+        # it may in turn be waiting on urls we hold, so publish ours first
+        self.flush()
+        deadline = time.monotonic() + self.fetch_lock_seconds
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            with self.engine.connect() as connection:
+                still_locked = connection.execute(
+                    select(TBAFetchLock.url).where(TBAFetchLock.url == url)).first() is not None
+            if not still_locked:
+                tba_data = self._get_session().get(TBAData, url, populate_existing=True)
+                if tba_data is not None and (tba_data.etag, tba_data.date, tba_data.expires) != before:
+                    return tba_data
+                return None
+        return None
+
+    @contextlib.contextmanager
+    def bulk(self):
+        # requests made by this thread inside the block wait behind everyone else's
+        previous = self._priority()
+        self.local.priority = BULK
+        try:
+            yield self
+        finally:
+            self.local.priority = previous
+
+    def _priority(self):
+        return getattr(self.local, 'priority', INTERACTIVE)
+
+    def _request(self, url, etag=None, priority=None):
+        priority = self._priority() if priority is None else priority
+        for attempt in range(self.max_retries + 1):
+            waited, queue_depth = self.scheduler.acquire(priority)
+            self.stats.record_schedule(PRIORITY_NAMES[priority], waited, queue_depth)
+            t0 = time.perf_counter()
+            try:
+                response = self._get(url, etag)
+            finally:
+                self.scheduler.release()
+            self.stats.record_http(url, response.status_code, wire_size(response), len(response.content or b''),
+                                   time.perf_counter() - t0)
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+            seconds = retry_after_seconds(response.headers, self.backoff_factor * 2 ** attempt)
+            self.logger.warning("throttled on %s, holding requests for %.1fs", url, seconds)
+            self.stats.record_throttle(seconds)
+            self.scheduler.pause(seconds)
+
+    def _get(self, url, etag=None):
+        # only does network i/o, so it is safe to call from worker threads
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+
+        # a projected url's key carries the projection name as a fragment
+        response = self.http.get(self.base_url + url.partition('#')[0], headers=headers, stream=True)
+        try:
+            # read the body here rather than through response.content: urllib3 only counts the bytes it
+            # read off the wire (for wire_size) on this path, not on the chunked one requests would take
+            response._content = response.raw.read(decode_content=True)
+        except urllib3.exceptions.HTTPError as e:
+            response.close()
+            raise requests.ConnectionError(e, response=response) from e
+        # read to the end, so urllib3 has already put the connection back in the pool
+        return response
+
+    def _store_response(self, url, existing_tba_data, response):
+        self.logger.info("got a %d for %s", response.status_code, url)
+
+        if response.status_code == 404:
+            # remembered as a null payload; fetch() returns None, as for a null body
+            payload = new_payload(b'null', self.compression)
+            tba_data = TBAData(
+                url=url,
+                etag='',
+                date=datetime.datetime.now().astimezone(),
+                payload_hash=payload.hash,
+                expires=datetime.datetime.now() + datetime.timedelta(seconds=self.negative_ttl),
+                payload_size=4,
+                negative='404',
+            )
+            tba_data.payload = payload
+            self._replace_payload(existing_tba_data, payload)
+            self.memory.put(url, tba_data)
+            self._store(tba_data, release=url, payload=payload)
+            return tba_data
+
+        # throw exception for any other 4xx or 5xx
+        response.raise_for_status()
+
+        # check for other catastrophic codes here
+
+        # and we are good!
+
+        if response.status_code == 304:
+            if existing_tba_data.negative is not None:
+                existing_tba_data.expires = datetime.datetime.now() + datetime.timedelta(seconds=self.negative_ttl)
+            else:
+                existing_tba_data.expires = self._expires(url, response)
+            self._store(existing_tba_data, release=url)
+            self.memory.put(url, existing_tba_data)
+            return existing_tba_data
+
+        content = response.content
+        data = None
+        url_path, _, projection_name = url.partition('#')
+        if projection_name != '':
+            data = json.loads(content)
+            if self.normalize:
+                # the entity tables get everything, even if this row won't
+                with self.lock:
+                    self.pending_ingest.append((url_path, data))
+            data = self.projections[projection_name][1].apply(data)
+            content = json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+        payload = new_payload(content, self.compression)
+        tba_data = TBAData(
+            url=url,
+            etag=response.headers['etag'],
+            date=datetime.datetime.now().astimezone(),
+            payload_hash=payload.hash,
+            expires=self._expires(url, response),
+            payload_size=len(content),
+        )
+        if content.strip() == b'null':
+            tba_data.negative = 'null'
+            tba_data.expires = datetime.datetime.now() + datetime.timedelta(seconds=self.negative_ttl)
+        payload.data_cache = data
+        if self.binary_encoding is not None:
+            payload.encode_binary(self.binary_encoding)
+        tba_data.payload = payload
+        self._replace_payload(existing_tba_data, payload)
+        # the memory tier may swap in an identical body it already holds, so this one is kept for the write
+        self.memory.put(url, tba_data)
+        if self.normalize and projection_name == '':
+            with self.lock:
+                self.pending_ingest.append((url, tba_data.data))
+        self._store(tba_data, release=url, payload=payload)
+
+        return tba_data
+
+    def _replace_payload(self, existing_tba_data, payload):
+        if existing_tba_data is not None and existing_tba_data.payload_hash not in (None, payload.hash):
+            with self.lock:
+                self.replaced_payloads.add(existing_tba_data.payload_hash)
+
+    def _store(self, tba_data, release=None, payload=None):
+        # payload: also write the body (if it is new, or to add a binary copy of it)
+        with self.lock:
+            self.pending_writes.append({c.name: getattr(tba_data, c.name) for c in self._stored_columns()})
+            if payload is not None:
+                self.pending_payloads.append({c.name: getattr(payload, c.name) for c in TBAPayload.__table__.columns})
+            if release is not None:
+                self.pending_releases.append(release)
+            wait_ms = self.commit_ms - (time.monotonic() - self.last_commit) * 1000
+            due = not self.write_behind or len(self.pending_writes) >= self.commit_rows or wait_ms <= 0
+            if not due and self.flush_timer is None:
+                self.flush_timer = threading.Timer(wait_ms / 1000.0, self._flush_on_timer)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+        if due:
+            self.flush()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except Exception as e:
+            # nobody is waiting on this thread to see it
+            self.logger.warning("timed flush failed: %s", e)
+        finally:
+            self.Session.remove()
+
+    @staticmethod
+    def _stored_columns():
+        # last_access and hit_count are only ever bumped by flush(), never overwritten by a fetch
+        return [c for c in TBAData.__table__.columns if c.name not in ('last_access', 'hit_count')]
+
+    def flush(self):
+        # upsert everything pending in one transaction, on the calling thread's session
+        with self.flush_lock:
+            with self.lock:
+                if self.flush_timer is not None:
+                    self.flush_timer.cancel()
+                    self.flush_timer = None
+                pending_writes, self.pending_writes = self.pending_writes, []
+                pending_payloads, self.pending_payloads = self.pending_payloads, []
+                replaced_payloads, self.replaced_payloads = self.replaced_payloads, set()
+                pending_access, self.pending_access = self.pending_access, {}
+                pending_ingest, self.pending_ingest = self.pending_ingest, []
+                pending_releases, self.pending_releases = self.pending_releases, []
+                self.flushing = pending_releases
+            try:
+                self._write_pending(pending_writes, pending_payloads, replaced_payloads, pending_access,
+                                    pending_ingest, pending_releases)
+            finally:
+                with self.lock:
+                    self.flushing = []
+
+    def _write_pending(self, pending_writes, pending_payloads, replaced_payloads, pending_access, pending_ingest,
+                       pending_releases):
+        session = self._get_session()
+        if len(pending_payloads) > 0:
+            # a body that is already stored stays as it is, except that it can pick up a binary copy
+            # (which is only usable if it was compressed the same way), or lose one in a format
+            # that is no longer read
+            stmt = insert(TBAPayload)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[TBAPayload.hash],
+                set_={'data_bin': stmt.excluded.data_bin, 'data_bin_version': stmt.excluded.data_bin_version},
+                where=TBAPayload.compression.is_not_distinct_from(stmt.excluded.compression)
+                & (stmt.excluded.data_bin_version.is_not(None)
+                   | and_(*(TBAPayload.data_bin_version != tag for tag in BINARY_ENCODINGS))),
+            )
+            session.execute(stmt, pending_payloads)
+        if len(pending_writes) > 0:
+            stmt = insert(TBAData)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[TBAData.url],
+                set_={c.name: stmt.excluded[c.name] for c in self._stored_columns() if not c.primary_key},
+            )
+            session.execute(stmt, pending_writes)
+            self.logger.debug("wrote %d rows", len(pending_writes))
+        if len(pending_access) > 0:
+            now = datetime.datetime.now()
+            table = TBAData.__table__
+            stmt = update(table) \
+                .where(table.c.url == bindparam('b_url')) \
+                .values(last_access=now, hit_count=func.coalesce(table.c.hit_count, 0) + bindparam('b_hits'))
+            session.execute(stmt, [{'b_url': url, 'b_hits': hits} for url, hits in pending_access.items()])
+        if len(replaced_payloads) > 0:
+            delete_unreferenced_payloads(session, replaced_payloads)
+        for url, data in pending_ingest:
+            ingest(session, url, data)
+        session.commit()
+        self.last_commit = time.monotonic()
+
+        # only now can processes waiting on these urls read what we fetched
+        if self.single_flight and len(pending_releases) > 0:
+            with self.engine.begin() as connection:
+                connection.execute(delete(TBAFetchLock).where(
+                    TBAFetchLock.url.in_(pending_releases), TBAFetchLock.owner == self.owner))
+
+    def _expires(self, url, response):
+        lifetime = freshness_lifetime(response.headers)
+        for pattern, seconds in self.freshness_overrides:
+            if pattern.search(url):
+                if seconds is None:
+                    return datetime.datetime.max
+                lifetime = seconds
+                break
+        return datetime.datetime.now() + datetime.timedelta(seconds=lifetime)
+
+    @staticmethod
+    def _is_fresh(tba_data):
+        return tba_data.expires is not None and tba_data.expires > datetime.datetime.now()
+
+    def fetch_prefix(self, prefix, batch_size=500):
+        # cache-only scan: yields (url, data) for every stored url starting with prefix, in url order.
+        # a range on the primary key, so it is one sequential index read rather than a lookup per url.
+        self.flush()
+        stmt = select(TBAData) \
+            .where(TBAData.url >= prefix, TBAData.url < prefix + '\U0010ffff') \
+            .order_by(TBAData.url) \
+            .execution_options(yield_per=batch_size)
+        # a session of its own, so fetch() calls inside the loop can't empty it under us
+        with self.session_factory() as session:
+            for tba_data in session.scalars(stmt):
+                yield tba_data.url, tba_data.data
+
+    def fetch_many(self, urls, batch_size=500):
+        # cache-only: yields (url, data) for the urls that are stored, one query per batch_size urls
+        self.flush()
+        keys = {self._cache_key(url): url for url in urls}
+        key_list = list(keys)
+        with self.session_factory() as session:
+            for i in range(0, len(key_list), batch_size):
+                stmt = select(TBAData).where(TBAData.url.in_(key_list[i:i + batch_size])).order_by(TBAData.url)
+                for tba_data in session.scalars(stmt):
+                    yield keys[tba_data.url], tba_data.data
+
+    def prefetch_many(self, urls, max_concurrency=8, priority=None):
+        # warm the cache for a batch of urls: fetch()'s lookups run on a thread pool, so the
+        # conditional GETs overlap, and later fetch() calls are memory hits.
+        # returns the urls that could not be fetched.
+        keys = [key for key in dict.fromkeys(self._cache_key(url) for url in urls) if key not in self.memory]
+        failed = []
+        if len(keys) == 0:
+            return failed
+
+        # the workers make their requests at the caller's priority
+        priority = self._priority() if priority is None else priority
+        self.logger.info("prefetching %d urls, %d at a time", len(keys), max_concurrency)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = {executor.submit(self._fetch_entry, key, count_access=False, priority=priority): key
+                       for key in keys}
+            for future in concurrent.futures.as_completed(futures):
+                key = futures[future]
+                try:
+                    future.result()
+                except requests.RequestException as e:
+                    # leave it for fetch() to retry and report
+                    self.logger.warning("prefetch of %s failed: %s", key, e)
+                    failed.append(key.partition('#')[0])
+        return failed
+
+    def done(self):
+        # let background revalidations finish, so what they fetched gets written too
+        with self.lock:
+            revalidator, self.revalidator = self.revalidator, None
+        if revalidator is not None:
+            revalidator.shutdown(wait=True)
+        self.flush()
+        self.Session.remove()
+
     def make_avatar(self, team_key=None, year=None):
-        media_list = self.get_team_media(team_key=team_key, year=year)
-        if media_list is not None:
-            for media in media_list:
-                if media['type'] == 'avatar':
-                    fk = media['foreign_key']
-                    b64 = media.get('details', {}).get('base64Image', None)
-                    if b64 is not None:
-                        content = base64.b64decode(b64)
-                        fn = f"avatars/{fk}.png"
-                        with open(fn, "wb") as f:
-                            f.write(content)
+        return self.export_avatars([team_key], year).get(team_key, None)
+
+    def export_avatars(self, team_keys, year, directory='avatars', max_concurrency=8):
+        # media for all the teams is fetched in parallel, and only changed avatars are rewritten.
+        # returns team key -> avatar path, and keeps directory/manifest.json up to date
+        team_keys = list(dict.fromkeys(team_keys))
+        urls = TBAUrlCollector()
+        for team_key in team_keys:
+            urls.get_team_media(team_key, year)
+        self.prefetch_many(urls.urls, max_concurrency=max_concurrency)
+        media_by_team = {team_key: self.get_team_media(team_key, year) for team_key in team_keys}
+        return write_avatars(media_by_team, year, directory=directory, max_workers=max_concurrency)
 
 
 def main(argv):
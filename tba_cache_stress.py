@@ -0,0 +1,100 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import requests
+
+import tba_cache
+
+
+class StressCache(tba_cache.TBACache):
+    # answers from a synthetic api instead of thebluealliance.com, and records every "network" request
+
+    def __init__(self, latency=0.02, max_age=60, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.max_age = max_age
+        self.network_urls = []
+
+    def _get(self, url, etag=None):
+        time.sleep(self.latency)
+        self.network_urls.append(url)
+        body = json.dumps({'url': url, 'items': list(range(100))}).encode()
+        response = requests.Response()
+        response.url = url
+        response.headers['etag'] = 'W/"' + hashlib.md5(body).hexdigest() + '"'
+        response.headers['Cache-Control'] = f'public, max-age={self.max_age}'
+        if etag == response.headers['etag']:
+            response.status_code = 304
+        else:
+            response.status_code = 200
+            response._content = body
+        return response
+
+
+def worker(db_file_name, urls, rounds, seed, write_behind, max_age):
+    random.seed(seed)
+    errors = []
+    with StressCache(db_file_name=db_file_name, write_behind=write_behind, max_age=max_age) as cache:
+        for _ in range(rounds):
+            # a new memory tier every round, so every round goes back to the db and the "network"
+            cache.memory = tba_cache.MemoryTier(max_bytes=cache.memory.max_bytes)
+            for url in random.sample(urls, len(urls)):
+                try:
+                    data = cache.fetch(url)
+                    if data['url'] != url:
+                        errors.append(f'{url}: wrong payload')
+                except Exception as e:
+                    errors.append(f'{url}: {e!r}')
+    return cache.network_urls, errors
+
+
+def main(argv):
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="database file, recreated by this test", default='tba_stress.db')
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--urls", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--write-behind", action='store_true')
+    parser.add_argument("--max-age", type=int, default=60,
+                        help="freshness the synthetic api grants; with 0 every fetch revalidates")
+    args = parser.parse_args(argv)
+
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+    # create the schema once, up front
+    tba_cache.TBACache(db_file_name=args.db).done()
+
+    urls = [f'/api/v3/event/stress{i}/matches' for i in range(args.urls)]
+    t0 = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.starmap(worker, [(args.db, urls, args.rounds, seed, args.write_behind, args.max_age)
+                                        for seed in range(args.processes)])
+    elapsed = time.perf_counter() - t0
+
+    network_urls = [url for urls_fetched, _ in results for url in urls_fetched]
+    errors = [error for _, errors in results for error in errors]
+    for error in errors[:20]:
+        print(error)
+    summary = {
+        'processes': args.processes,
+        'fetches': args.processes * args.rounds * len(urls),
+        'network_requests': len(network_urls),
+        'distinct_urls': len(set(network_urls)),
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+    }
+    print(json.dumps(summary))
+    return 1 if len(errors) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,196 @@
 import argparse
+import codecs
 import datetime
+import hashlib
+import io
 import logging
 import json
+import marshal
+import os
 import sys
+import time
 import typing
+import zlib
 
 import sqlalchemy.orm.exc
 
 from typing import Optional
 
-from sqlalchemy import Text, DateTime, create_engine
-from sqlalchemy.orm import DeclarativeBase, mapped_column
+from sqlalchemy import Boolean, ForeignKey, Integer, LargeBinary, Text, DateTime, bindparam, create_engine, delete, \
+    inspect, text, select, update
+from sqlalchemy.orm import DeclarativeBase, Session, mapped_column, relationship
 from sqlalchemy.orm.base import Mapped
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSIONS = ['zlib', 'zstd']
+
+
+def compress_payload(raw, compression=None):
+    if compression is None:
+        return raw
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    if compression == 'zlib':
+        return zlib.compress(raw, 6)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    raise ValueError(f"unknown compression {compression}")
+
+
+def decompress_payload(payload, compression=None):
+    if compression is None:
+        return payload
+    if compression == 'zlib':
+        return zlib.decompress(payload)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compressed payload, but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"unknown compression {compression}")
+
+
+def decompress_chunks(payload, compression=None, chunk_size=64 * 1024):
+    # decompress_payload, a piece at a time
+    if compression is None:
+        for i in range(0, len(payload), chunk_size):
+            yield payload[i:i + chunk_size]
+    elif compression == 'zlib':
+        decompressor = zlib.decompressobj()
+        data = payload
+        while len(data) > 0:
+            yield decompressor.decompress(data, chunk_size)
+            data = decompressor.unconsumed_tail
+        yield decompressor.flush()
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compressed payload, but the zstandard package is not installed")
+        yield from zstandard.ZstdDecompressor().read_to_iter(io.BytesIO(payload), write_size=chunk_size)
+    else:
+        raise ValueError(f"unknown compression {compression}")
+
+
+def iter_json(chunks):
+    # yields the elements of a json array, or the (key, value) pairs of a json object, holding only
+    # the current element and one chunk of text in memory. anything else is yielded whole.
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    pos = 0
+    exhausted = False
+
+    def more():
+        nonlocal buffer, pos, exhausted
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer = buffer[pos:] + utf8.decode(b'', final=True)
+        else:
+            buffer = buffer[pos:] + (chunk if isinstance(chunk, str) else utf8.decode(chunk))
+        pos = 0
+
+    def skip(separators):
+        # past whitespace and the given separators; returns the next character, or '' at the end
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in separators):
+                pos += 1
+            if pos < len(buffer) or exhausted:
+                return buffer[pos:pos + 1]
+            more()
+
+    def value():
+        # the next complete value. a number is only complete once something other than more of it follows:
+        # with '1.5' split after '1.', raw_decode returns 1 and stops at the '.'
+        nonlocal pos
+        while True:
+            try:
+                v, end = decoder.raw_decode(buffer, pos)
+                is_number = isinstance(v, (int, float)) and not isinstance(v, bool)
+                if exhausted or (end < len(buffer) and (not is_number or buffer[end] in ',]} \t\r\n')):
+                    pos = end
+                    return v
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+            more()
+
+    first = skip('')
+    if first == '[':
+        pos += 1
+        while skip(',') not in (']', ''):
+            yield value()
+    elif first == '{':
+        pos += 1
+        while skip(',') not in ('}', ''):
+            key = value()
+            if skip('') != ':':
+                raise ValueError("malformed json object")
+            pos += 1
+            skip('')
+            yield key, value()
+    elif first != '':
+        v = value()
+        if v is not None:
+            yield v
+
+
+def check_iter_json(text):
+    # iter_json must give the same result however the text is split into chunks; returns the split
+    # offsets where it doesn't
+    expected = json.loads(text)
+    if isinstance(expected, dict):
+        expected = list(expected.items())
+    elif not isinstance(expected, list):
+        expected = [] if expected is None else [expected]
+    raw = text.encode('utf-8')
+    failed = []
+    for i in range(len(raw) + 1):
+        try:
+            if list(iter_json([raw[:i], raw[i:]])) != expected:
+                failed.append(i)
+        except ValueError:
+            failed.append(i)
+    return failed
+
+
+ITER_JSON_SAMPLES = [
+    '[1.5, 2e3, -0.25, 10E-2, 7, true, null, "x,y]"]',
+    '{"x": 1.25, "y": [1, {"z": 2.5e+1}], "w": "caf\u00e9 é"}',
+    '[]',
+    '{}',
+    '12.5',
+    'null',
+]
+
+
+# binary encodings of a parsed payload, keyed by version tag. bump the tag when the format changes:
+# rows carrying an old tag for the same encoding are rebuilt from the json the next time they are read.
+# only formats that can't run code when loaded: the db is shared between processes and served as a
+# snapshot by tba_standin.py. rows left with a tag not listed here (e.g. 'pickle:5') just read the json
+BINARY_ENCODINGS = {
+    'marshal:4': (lambda o: marshal.dumps(o, 4), marshal.loads),
+}
+
+# what a corrupt or foreign binary copy raises on decode
+BINARY_DECODE_ERRORS = (ValueError, EOFError, TypeError, zlib.error) + \
+    (() if zstandard is None else (zstandard.ZstdError,))
+
+
+def binary_version_tag(encoding):
+    # 'marshal' -> 'marshal:4'
+    for tag in BINARY_ENCODINGS.keys():
+        if tag.partition(':')[0] == encoding:
+            return tag
+    return None
+
 
 class Base(DeclarativeBase):
     # https://stackoverflow.com/a/11884806
@@ -45,31 +223,343 @@ class Base(DeclarativeBase):
         return self._repr(**self.as_dict())
 
 
-class TBAData(Base):
-    __tablename__ = 'tba'
+class TBAPayload(Base):
+    # a payload body, stored once however many urls returned it, keyed by the sha1 of its uncompressed json
+    __tablename__ = 'tba_payload'
 
-    url: Mapped[str] = mapped_column(Text, primary_key=True)
-    date: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime)
-    etag: Mapped[str] = mapped_column(Text)
+    hash: Mapped[str] = mapped_column(Text, primary_key=True)
+    # raw json text, or json compressed as named by the compression column (None = not compressed)
     data_json: Mapped[str] = mapped_column(Text)
+    compression: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # optional pre-parsed copy of the payload (same compression as data_json), preferred on read
+    data_bin: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
+    data_bin_version: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
     data_cache = None
 
     @property
     def data(self):
         if self.data_cache is None:
-            self.data_cache = json.loads(self.data_json)
+            codec = BINARY_ENCODINGS.get(self.data_bin_version, None)
+            decoded = False
+            if self.data_bin is not None and codec is not None:
+                try:
+                    self.data_cache = codec[1](decompress_payload(self.data_bin, self.compression))
+                    decoded = True
+                except BINARY_DECODE_ERRORS as e:
+                    logging.warning("unreadable %s copy of payload %s, rebuilding it: %r",
+                                    self.data_bin_version, self.hash, e)
+            if not decoded:
+                self.data_cache = json.loads(decompress_payload(self.data_json, self.compression))
+                if self.data_bin_version is not None:
+                    # stale or unreadable encoding, rebuild it (or drop it if the encoding is gone)
+                    self.encode_binary(self.data_bin_version.partition(':')[0])
         return self.data_cache
 
+    def iter_data(self):
+        # like iterating over data (elements of a list, (key, value) pairs of a dict), but streamed
+        # from the stored json: large payloads are never decoded all at once
+        if self.data_cache is not None or (self.data_bin is not None and self.data_bin_version in BINARY_ENCODINGS):
+            data = self.data
+            if isinstance(data, dict):
+                yield from data.items()
+            elif isinstance(data, list):
+                yield from data
+            elif data is not None:
+                yield data
+        else:
+            yield from iter_json(decompress_chunks(self.data_json, self.compression))
+
+    def encode_binary(self, encoding):
+        tag = binary_version_tag(encoding)
+        if tag is None:
+            self.data_bin = None
+            self.data_bin_version = None
+        else:
+            self.data_bin = compress_payload(BINARY_ENCODINGS[tag][0](self.data), self.compression)
+            self.data_bin_version = tag
+
+
+def payload_hash(raw):
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()
+
+
+def new_payload(raw, compression=None):
+    return TBAPayload(hash=payload_hash(raw), data_json=compress_payload(raw, compression), compression=compression)
+
+
+class TBAData(Base):
+    __tablename__ = 'tba'
+
+    url: Mapped[str] = mapped_column(Text, primary_key=True)
+    date: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime, index=True)
+    etag: Mapped[str] = mapped_column(Text)
+    # the body, in tba_payload; urls returning byte-identical bodies point at the same row
+    payload_hash: Mapped[Optional[str]] = mapped_column(Text, ForeignKey('tba_payload.hash'), nullable=True,
+                                                        index=True)
+    # end of the freshness lifetime TBA gave us (Cache-Control max-age / Expires), in local time
+    expires: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime, nullable=True)
+    # bookkeeping for clean_tba_cache.py: uncompressed json size, and how often / recently it was read
+    payload_size: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    last_access: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime, nullable=True, index=True)
+    hit_count: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # set on negative results, kept for their own ttl: '404' (payload is null, etag empty) or 'null' (a null body)
+    negative: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    # loaded with the row. rows are only ever written with insert statements, never through this
+    payload: Mapped[Optional[TBAPayload]] = relationship(lazy='joined', viewonly=True)
+
+    @property
+    def data(self):
+        return None if self.payload is None else self.payload.data
+
+    def iter_data(self):
+        if self.payload is not None:
+            yield from self.payload.iter_data()
+
+
+class TBASyncProgress(Base):
+    # checkpoints for tba_sync.py: one row per event finished by an unfinished sync
+    __tablename__ = 'tba_sync'
+
+    sync_key: Mapped[str] = mapped_column(Text, primary_key=True)
+    event_key: Mapped[str] = mapped_column(Text, primary_key=True)
+    completed: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime)
+
+
+class TBAFetchLock(Base):
+    # a url some process is fetching right now, so other processes wait for its result instead
+    __tablename__ = 'tba_fetch_lock'
+
+    url: Mapped[str] = mapped_column(Text, primary_key=True)
+    owner: Mapped[str] = mapped_column(Text)
+    expires: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+
+# normalized tables, filled from TBA payloads by tba_ingest.py so analyses can be SQL queries
+
+class Event(Base):
+    __tablename__ = 'event'
+
+    key: Mapped[str] = mapped_column(Text, primary_key=True)
+    year: Mapped[Optional[int]] = mapped_column(Integer, index=True)
+    event_code: Mapped[Optional[str]] = mapped_column(Text)
+    name: Mapped[Optional[str]] = mapped_column(Text)
+    short_name: Mapped[Optional[str]] = mapped_column(Text)
+    event_type: Mapped[Optional[int]] = mapped_column(Integer, index=True)
+    week: Mapped[Optional[int]] = mapped_column(Integer, index=True)
+    district_key: Mapped[Optional[str]] = mapped_column(Text, index=True)
+    city: Mapped[Optional[str]] = mapped_column(Text)
+    state_prov: Mapped[Optional[str]] = mapped_column(Text)
+    country: Mapped[Optional[str]] = mapped_column(Text)
+    start_date: Mapped[Optional[str]] = mapped_column(Text, index=True)
+    end_date: Mapped[Optional[str]] = mapped_column(Text)
+
+
+class Team(Base):
+    __tablename__ = 'team'
+
+    key: Mapped[str] = mapped_column(Text, primary_key=True)
+    team_number: Mapped[Optional[int]] = mapped_column(Integer, index=True)
+    nickname: Mapped[Optional[str]] = mapped_column(Text)
+    name: Mapped[Optional[str]] = mapped_column(Text)
+    city: Mapped[Optional[str]] = mapped_column(Text)
+    state_prov: Mapped[Optional[str]] = mapped_column(Text)
+    country: Mapped[Optional[str]] = mapped_column(Text)
+    rookie_year: Mapped[Optional[int]] = mapped_column(Integer)
+
+
+class Match(Base):
+    __tablename__ = 'match'
+
+    key: Mapped[str] = mapped_column(Text, primary_key=True)
+    event_key: Mapped[str] = mapped_column(Text, index=True)
+    comp_level: Mapped[Optional[str]] = mapped_column(Text, index=True)
+    set_number: Mapped[Optional[int]] = mapped_column(Integer)
+    match_number: Mapped[Optional[int]] = mapped_column(Integer)
+    actual_time: Mapped[Optional[int]] = mapped_column(Integer)
+    red_score: Mapped[Optional[int]] = mapped_column(Integer)
+    blue_score: Mapped[Optional[int]] = mapped_column(Integer)
+    winning_alliance: Mapped[Optional[str]] = mapped_column(Text)
+
+
+class AllianceTeam(Base):
+    __tablename__ = 'alliance_team'
+
+    match_key: Mapped[str] = mapped_column(Text, primary_key=True)
+    team_key: Mapped[str] = mapped_column(Text, primary_key=True, index=True)
+    event_key: Mapped[str] = mapped_column(Text, index=True)
+    color: Mapped[str] = mapped_column(Text)
+    station: Mapped[int] = mapped_column(Integer)
+    surrogate: Mapped[bool] = mapped_column(Boolean, default=False)
+    dq: Mapped[bool] = mapped_column(Boolean, default=False)
+
+
+class TeamEventStatus(Base):
+    __tablename__ = 'team_event_status'
+
+    team_key: Mapped[str] = mapped_column(Text, primary_key=True)
+    event_key: Mapped[str] = mapped_column(Text, primary_key=True, index=True)
+    qual_rank: Mapped[Optional[int]] = mapped_column(Integer)
+    num_teams: Mapped[Optional[int]] = mapped_column(Integer)
+    qual_wins: Mapped[Optional[int]] = mapped_column(Integer)
+    qual_losses: Mapped[Optional[int]] = mapped_column(Integer)
+    qual_ties: Mapped[Optional[int]] = mapped_column(Integer)
+    playoff_status: Mapped[Optional[str]] = mapped_column(Text)
+    playoff_level: Mapped[Optional[str]] = mapped_column(Text)
+    overall_status_str: Mapped[Optional[str]] = mapped_column(Text)
+    alliance_status_str: Mapped[Optional[str]] = mapped_column(Text)
+
+
+def migrate_schema(engine):
+    # create missing tables, and add columns that were introduced after a table was first created
+    Base.metadata.create_all(engine)
+    if 'data_json' in {c['name'] for c in inspect(engine).get_columns('tba')}:
+        move_payloads_out_of_tba(engine)
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    logging.info("adding column %s.%s", table.name, column.name)
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def move_payloads_out_of_tba(engine, batch_size=500):
+    # tba rows used to carry their own payload columns: store each distinct body once in tba_payload,
+    # and rebuild tba without them
+    columns = {c['name'] for c in inspect(engine).get_columns('tba')}
+    # columns added along the way may be missing from an older db
+    optional = ', '.join(name if name in columns else 'NULL'
+                         for name in ('compression', 'data_bin', 'data_bin_version'))
+    logging.info("moving payloads from tba to tba_payload")
+    hashes = {}
+    with engine.begin() as connection:
+        result = connection.execute(text(f'SELECT url, data_json, {optional} FROM tba'))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            payloads = {}
+            for url, data_json, compression, data_bin, data_bin_version in rows:
+                hashes[url] = payload_hash(decompress_payload(data_json, compression))
+                payloads[hashes[url]] = {'hash': hashes[url], 'data_json': data_json, 'compression': compression,
+                                         'data_bin': data_bin, 'data_bin_version': data_bin_version}
+            connection.execute(TBAPayload.__table__.insert().prefix_with('OR IGNORE'), list(payloads.values()))
+
+        for index in inspect(connection).get_indexes('tba'):
+            connection.execute(text(f'DROP INDEX {index["name"]}'))
+        connection.execute(text('ALTER TABLE tba RENAME TO tba_inline'))
+        TBAData.__table__.create(connection)
+        copied = ', '.join(c.name for c in TBAData.__table__.columns if c.name in columns)
+        connection.execute(text(f'INSERT INTO tba ({copied}) SELECT {copied} FROM tba_inline'))
+        connection.execute(text('DROP TABLE tba_inline'))
+        table = TBAData.__table__
+        stmt = update(table).where(table.c.url == bindparam('b_url')).values(payload_hash=bindparam('b_hash'))
+        urls = list(hashes.items())
+        for i in range(0, len(urls), batch_size):
+            connection.execute(stmt, [{'b_url': url, 'b_hash': h} for url, h in urls[i:i + batch_size]])
+    logging.info("%d urls, %d distinct payloads; VACUUM to give back the space", len(hashes), len(set(hashes.values())))
+
+
+def delete_unreferenced_payloads(session, hashes=None):
+    # payloads no url points at any more (of the given hashes, if any); returns how many went
+    stmt = delete(TBAPayload).where(~select(TBAData.url).where(TBAData.payload_hash == TBAPayload.hash).exists())
+    if hashes is None:
+        return session.execute(stmt).rowcount
+    hashes = list(hashes)
+    count = 0
+    for i in range(0, len(hashes), 500):
+        count += session.execute(stmt.where(TBAPayload.hash.in_(hashes[i:i + 500]))).rowcount
+    return count
+
+
+def recompress_rows(engine, compression=None, batch_size=500):
+    # rewrite every payload not already stored with the wanted compression
+    if compression is None:
+        needs_work = TBAPayload.compression.is_not(None)
+    else:
+        needs_work = TBAPayload.compression.is_(None) | (TBAPayload.compression != compression)
+    count = 0
+    with Session(engine) as session:
+        while True:
+            rows = session.scalars(select(TBAPayload).where(needs_work).limit(batch_size)).all()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                raw = decompress_payload(row.data_json, row.compression)
+                row.data_json = compress_payload(raw, compression)
+                if row.data_bin is not None:
+                    row.data_bin = compress_payload(decompress_payload(row.data_bin, row.compression), compression)
+                row.compression = compression
+            session.commit()
+            count += len(rows)
+            logging.info("recompressed %d rows", count)
+    return count
+
+
+def read_latency_ms(engine, sample_size=200):
+    # average time to decode (decompress + json.loads) a payload, over a sample of rows
+    with Session(engine) as session:
+        rows = session.execute(select(TBAPayload.data_json, TBAPayload.compression).limit(sample_size)).all()
+    if len(rows) == 0:
+        return 0.0
+    t0 = time.perf_counter()
+    for data_json, compression in rows:
+        json.loads(decompress_payload(data_json, compression))
+    return (time.perf_counter() - t0) * 1000.0 / len(rows)
+
+
 def main(argv):
     parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="database file", default='tba.db')
+    parser.add_argument("--compress", choices=COMPRESSIONS + ['none'],
+                        help="recompress existing payloads, and report the size and read latency change")
+    parser.add_argument("--check-iter-json", action='store_true',
+                        help="check the streaming json reader against json.loads, split at every offset")
     args = parser.parse_args(argv)
 
-    db_filename = 'tba.db'
+    if args.check_iter_json:
+        failed = False
+        for sample in ITER_JSON_SAMPLES:
+            offsets = check_iter_json(sample)
+            if len(offsets) > 0:
+                logging.error("iter_json differs from json.loads on %r split at %s", sample, offsets)
+                failed = True
+        logging.info("iter_json %s", "FAILED" if failed else "ok")
+        sys.exit(1 if failed else 0)
+
+    db_filename = args.db
     logging.info ("Creating database file %s", db_filename)
-    Base.metadata.create_all(create_engine(f'sqlite:///{db_filename}', echo=True))
+    engine = create_engine(f'sqlite:///{db_filename}', echo=args.compress is None)
+    migrate_schema(engine)
     logging.info("...created")
 
+    if args.compress is not None:
+        # fold any write-ahead log into the main file so the sizes compare like for like
+        with engine.connect() as connection:
+            connection.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+        size_before = os.path.getsize(db_filename)
+        latency_before = read_latency_ms(engine)
+
+        recompress_rows(engine, None if args.compress == 'none' else args.compress)
+        with engine.connect() as connection:
+            connection.execute(text('VACUUM'))
+            connection.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+
+        size_after = os.path.getsize(db_filename)
+        latency_after = read_latency_ms(engine)
+        logging.info("db size %d -> %d bytes (%.1f%%)", size_before, size_after,
+                     100.0 * size_after / max(size_before, 1))
+        logging.info("read latency %.3f -> %.3f ms per payload", latency_before, latency_after)
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,243 @@
+import argparse
+import logging
+import re
+import sys
+
+from sqlalchemy import create_engine, delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from tba_entities import AllianceTeam, Event, Match, TBAData, Team, TeamEventStatus, migrate_schema
+
+logger = logging.getLogger(__name__)
+
+# (url regex, function(session, data, **groups)); the first match wins
+INGESTERS = []
+
+
+def ingester(pattern):
+    def register(f):
+        INGESTERS.append((re.compile(pattern), f))
+        return f
+    return register
+
+
+def ingest(session, url, data):
+    # fill the normalized tables from one payload; returns whether the url is one we understand.
+    # ingesters build all their rows before touching the db, so a payload of an unexpected shape
+    # is skipped without leaving half its rows behind
+    if data is None:
+        return False
+    for pattern, f in INGESTERS:
+        m = pattern.fullmatch(url)
+        if m is not None:
+            try:
+                f(session, data, **m.groupdict())
+            except (KeyError, TypeError, AttributeError) as e:
+                logger.warning("not ingesting %s: unexpected payload (%r)", url, e)
+                return False
+            return True
+    return False
+
+
+def upsert(session, entity, rows):
+    # insert, or update the columns this payload has values for (simple payloads leave the rest alone)
+    if len(rows) == 0:
+        return
+    table = entity.__table__
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[c for c in table.primary_key.columns],
+        set_={c.name: func.coalesce(stmt.excluded[c.name], c) for c in table.columns if not c.primary_key},
+    )
+    session.execute(stmt, rows)
+
+
+def event_row(event):
+    district = event.get('district') or {}
+    return {
+        'key': event['key'],
+        'year': event.get('year'),
+        'event_code': event.get('event_code'),
+        'name': event.get('name'),
+        'short_name': event.get('short_name'),
+        'event_type': event.get('event_type'),
+        'week': event.get('week'),
+        'district_key': district.get('key'),
+        'city': event.get('city'),
+        'state_prov': event.get('state_prov'),
+        'country': event.get('country'),
+        'start_date': event.get('start_date'),
+        'end_date': event.get('end_date'),
+    }
+
+
+def team_row(team):
+    return {
+        'key': team['key'],
+        'team_number': team.get('team_number'),
+        'nickname': team.get('nickname'),
+        'name': team.get('name'),
+        'city': team.get('city'),
+        'state_prov': team.get('state_prov'),
+        'country': team.get('country'),
+        'rookie_year': team.get('rookie_year'),
+    }
+
+
+def status_row(team_key, event_key, status):
+    qual = status.get('qual') or {}
+    ranking = qual.get('ranking') or {}
+    record = ranking.get('record') or {}
+    playoff = status.get('playoff') or {}
+    return {
+        'team_key': team_key,
+        'event_key': event_key,
+        'qual_rank': ranking.get('rank'),
+        'num_teams': qual.get('num_teams'),
+        'qual_wins': record.get('wins'),
+        'qual_losses': record.get('losses'),
+        'qual_ties': record.get('ties'),
+        'playoff_status': playoff.get('status'),
+        'playoff_level': playoff.get('level'),
+        'overall_status_str': status.get('overall_status_str'),
+        'alliance_status_str': status.get('alliance_status_str'),
+    }
+
+
+def match_rows(matches):
+    match_rows = []
+    alliance_rows = []
+    for match in matches:
+        alliances = match.get('alliances') or {}
+        match_rows.append({
+            'key': match['key'],
+            'event_key': match['event_key'],
+            'comp_level': match.get('comp_level'),
+            'set_number': match.get('set_number'),
+            'match_number': match.get('match_number'),
+            'actual_time': match.get('actual_time'),
+            'red_score': (alliances.get('red') or {}).get('score'),
+            'blue_score': (alliances.get('blue') or {}).get('score'),
+            'winning_alliance': match.get('winning_alliance'),
+        })
+        for color, alliance in alliances.items():
+            for station, team_key in enumerate(alliance.get('team_keys') or [], start=1):
+                alliance_rows.append({
+                    'match_key': match['key'],
+                    'team_key': team_key,
+                    'event_key': match['event_key'],
+                    'color': color,
+                    'station': station,
+                    'surrogate': team_key in (alliance.get('surrogate_team_keys') or []),
+                    'dq': team_key in (alliance.get('dq_team_keys') or []),
+                })
+    return match_rows, alliance_rows
+
+
+def store_matches(session, match_rows, alliance_rows):
+    # a replayed match can change its teams (surrogates, corrections), so its alliance rows are rewritten
+    match_keys = [row['key'] for row in match_rows]
+    for i in range(0, len(match_keys), 500):
+        session.execute(delete(AllianceTeam).where(AllianceTeam.match_key.in_(match_keys[i:i + 500])))
+    upsert(session, Match, match_rows)
+    upsert(session, AllianceTeam, alliance_rows)
+
+
+@ingester(r'/api/v3/event/(?P<event_key>[^/]+)(/simple)?')
+def ingest_event(session, data, event_key):
+    upsert(session, Event, [event_row(data)])
+
+
+@ingester(r'/api/v3/(events/\d{4}|district/[^/]+/events|team/[^/]+/events(/\d{4})?)(/simple)?')
+def ingest_events(session, data):
+    upsert(session, Event, [event_row(event) for event in data])
+
+
+@ingester(r'/api/v3/(event/[^/]+/teams|district/[^/]+/teams|teams(/\d{4})?/\d+)(/simple)?')
+def ingest_teams(session, data):
+    upsert(session, Team, [team_row(team) for team in data])
+
+
+@ingester(r'/api/v3/team/(?P<team_key>frc\d+)(/simple)?')
+def ingest_team(session, data, team_key):
+    upsert(session, Team, [team_row(data)])
+
+
+@ingester(r'/api/v3/event/(?P<event_key>[^/]+)/matches')
+def ingest_event_matches(session, data, event_key):
+    # the full list for the event: anything not in it any more goes
+    rows = match_rows(data)
+    session.execute(delete(AllianceTeam).where(AllianceTeam.event_key == event_key))
+    session.execute(delete(Match).where(Match.event_key == event_key))
+    store_matches(session, *rows)
+
+
+@ingester(r'/api/v3/team/(?P<team_key>[^/]+)/event/(?P<event_key>[^/]+)/matches')
+def ingest_team_matches(session, data, team_key, event_key):
+    store_matches(session, *match_rows(data))
+
+
+@ingester(r'/api/v3/event/(?P<event_key>[^/]+)/teams/statuses')
+def ingest_event_statuses(session, data, event_key):
+    rows = [status_row(team_key, event_key, status) for team_key, status in data.items() if status is not None]
+    session.execute(delete(TeamEventStatus).where(TeamEventStatus.event_key == event_key))
+    upsert(session, TeamEventStatus, rows)
+
+
+@ingester(r'/api/v3/team/(?P<team_key>[^/]+)/event/(?P<event_key>[^/]+)/status')
+def ingest_team_status(session, data, team_key, event_key):
+    upsert(session, TeamEventStatus, [status_row(team_key, event_key, data)])
+
+
+def qual_matches_for_team(session, team_key, year):
+    # e.g. "all qual matches frc3620 played in 2025"
+    return session.scalars(
+        select(Match)
+        .join(AllianceTeam, AllianceTeam.match_key == Match.key)
+        .join(Event, Event.key == Match.event_key)
+        .where(AllianceTeam.team_key == team_key, Event.year == year, Match.comp_level == 'qm')
+        .order_by(Match.event_key, Match.match_number)).all()
+
+
+def events_in_week(session, year, week):
+    # TBA weeks are zero-based
+    return session.scalars(
+        select(Event).where(Event.year == year, Event.week == week).order_by(Event.start_date, Event.key)).all()
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="database file", default='tba.db')
+    parser.add_argument("--prefix", help="only (re)ingest urls starting with this", default='/api/v3/')
+    args = parser.parse_args(argv)
+
+    # backfill the normalized tables from what is already cached
+    engine = create_engine(f'sqlite:///{args.db}')
+    migrate_schema(engine)
+    # in url order, batch_size payloads at a time, each batch committed and let go of before the next
+    # is read, so a large cache is never in memory all at once
+    batch_size = 500
+    count = 0
+    last_url = None
+    with Session(engine) as session:
+        while True:
+            stmt = select(TBAData).where(TBAData.url >= args.prefix, TBAData.url < args.prefix + '\U0010ffff')
+            if last_url is not None:
+                stmt = stmt.where(TBAData.url > last_url)
+            rows = session.scalars(stmt.order_by(TBAData.url).limit(batch_size)).all()
+            if len(rows) == 0:
+                break
+            for tba_data in rows:
+                if ingest(session, tba_data.url, tba_data.data):
+                    count += 1
+            last_url = rows[-1].url
+            session.commit()
+            session.expunge_all()
+            logging.info("ingested %d payloads, up to %s", count, last_url)
+    logging.info("ingested %d payloads", count)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,107 @@
+import collections
+import threading
+
+from tba_entities import TBAData
+
+
+def stored_size(tba_data: TBAData):
+    # approximate footprint of an entry's body: its uncompressed json size if known, else the stored bytes
+    if tba_data.payload_size is not None:
+        return tba_data.payload_size
+    payload = tba_data.payload
+    if payload is None:
+        return 0
+    size = len(payload.data_json or b'')
+    if payload.data_bin is not None:
+        size += len(payload.data_bin)
+    return size
+
+
+class MemoryTier:
+    # in-process LRU of TBAData, bounded by entry count and/or bytes; None means no limit.
+    # shared by every thread using the cache, so all access is under a lock.
+    # entries with byte-identical bodies share one TBAPayload (so one parsed copy), counted once in the bytes
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: collections.OrderedDict[str, TBAData] = collections.OrderedDict()
+        # payload hash -> [TBAPayload, entries using it, size]
+        self.payloads = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, url):
+        with self.lock:
+            return url in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(url)
+            self.hits += 1
+            return entry
+
+    def put(self, url, tba_data: TBAData):
+        size = stored_size(tba_data)
+        with self.lock:
+            self._discard(url)
+            payload = tba_data.payload
+            if payload is not None:
+                shared = self.payloads.get(payload.hash, None)
+                if shared is None:
+                    shared = self.payloads[payload.hash] = [payload, 0, size]
+                    self.total_bytes += size
+                elif shared[0] is not payload:
+                    tba_data.payload = shared[0]
+                shared[1] += 1
+            self.entries[url] = tba_data
+            self._evict()
+
+    def discard(self, url):
+        with self.lock:
+            self._discard(url)
+
+    def _discard(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            self._release(entry)
+
+    def _release(self, tba_data):
+        if tba_data.payload is None:
+            return
+        shared = self.payloads[tba_data.payload.hash]
+        shared[1] -= 1
+        if shared[1] == 0:
+            del self.payloads[tba_data.payload.hash]
+            self.total_bytes -= shared[2]
+
+    def _evict(self):
+        # always keep the newest entry, even if it is over budget on its own
+        while len(self.entries) > 1 and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries)
+                or (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            _, tba_data = self.entries.popitem(last=False)
+            self._release(tba_data)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'payloads': len(self.payloads),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,78 @@
+import hashlib
+import json
+
+
+# paths are dotted keys, e.g. 'score_breakdown.red.totalPoints'; '*' stands for any key.
+# lists are walked through, so a path applies to every element (a /matches payload is a list of matches).
+
+def path_tree(paths):
+    # ['a.b', 'a.c', 'd'] -> {'a': {'b': {}, 'c': {}}, 'd': {}}; an empty dict marks the end of a path
+    tree = {}
+    for path in paths:
+        node = tree
+        for key in path.split('.'):
+            node = node.setdefault(key, {})
+    return tree
+
+
+def merge_trees(a, b):
+    # both sets of paths; an empty tree (keep the whole value) covers anything deeper
+    if len(a) == 0 or len(b) == 0:
+        return {}
+    merged = dict(a)
+    for key, subtree in b.items():
+        merged[key] = merge_trees(merged[key], subtree) if key in merged else subtree
+    return merged
+
+
+def keep_paths(data, tree):
+    if isinstance(data, list):
+        return [keep_paths(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+    kept = {}
+    for key, value in data.items():
+        subtrees = [t for t in (tree.get(key, None), tree.get('*', None)) if t is not None]
+        if len(subtrees) == 0:
+            continue
+        merged = subtrees[0] if len(subtrees) == 1 else merge_trees(*subtrees)
+        if len(merged) == 0:
+            kept[key] = value
+        else:
+            kept[key] = keep_paths(value, merged)
+    return kept
+
+
+def drop_paths(data, tree):
+    if isinstance(data, list):
+        return [drop_paths(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+    dropped = {}
+    for key, value in data.items():
+        subtrees = [t for t in (tree.get(key, None), tree.get('*', None)) if t is not None]
+        if any(len(t) == 0 for t in subtrees):
+            continue
+        for t in subtrees:
+            value = drop_paths(value, t)
+        dropped[key] = value
+    return dropped
+
+
+class Projection:
+    # a slimmed view of the payloads at urls matching pattern: only the keep paths, or all but the drop paths
+
+    def __init__(self, keep=None, drop=None):
+        if (keep is None) == (drop is None):
+            raise ValueError("a projection needs either keep or drop paths")
+        self.keep = None if keep is None else path_tree(keep)
+        self.drop = None if drop is None else path_tree(drop)
+        # stored under url#name: a different projection of the same url gets a different row. bump the
+        # version when apply() changes, so rows it projected differently aren't served
+        spec = json.dumps({'keep': sorted(keep or []), 'drop': sorted(drop or []), 'version': 2})
+        self.name = hashlib.sha1(spec.encode('utf-8')).hexdigest()[:12]
+
+    def apply(self, data):
+        if self.keep is not None:
+            return keep_paths(data, self.keep)
+        return drop_paths(data, self.drop)
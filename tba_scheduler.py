@@ -0,0 +1,102 @@
+import datetime
+import email.utils
+import heapq
+import itertools
+import threading
+import time
+
+# priority classes, most urgent first
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+
+class TokenBucket:
+    # `rate` requests per second on average, up to `burst` at once
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # returns 0 if a token was available, else the seconds until one will be
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+def retry_after_seconds(headers, default):
+    # Retry-After is either seconds or an http date
+    value = headers.get('Retry-After', None)
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class RequestScheduler:
+    # decides when each outbound request may go: no more than max_in_flight at once, no faster than
+    # the token bucket allows, nothing at all while a Retry-After is in force, and waiting requests
+    # go in priority order (then first come, first served)
+
+    def __init__(self, rate=None, burst=10, max_in_flight=None):
+        self.bucket = None if rate is None else TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        self.queue = []
+        self.order = itertools.count()
+
+    def queue_depth(self):
+        with self.condition:
+            return len(self.queue)
+
+    def acquire(self, priority=INTERACTIVE):
+        # blocks until this request may be sent; returns (seconds waited, queue depth on arrival).
+        # every acquire() must be matched by a release()
+        t0 = time.monotonic()
+        with self.condition:
+            entry = (priority, next(self.order))
+            depth = len(self.queue)
+            heapq.heappush(self.queue, entry)
+            while True:
+                timeout = None
+                if self.queue[0] == entry \
+                        and (self.max_in_flight is None or self.in_flight < self.max_in_flight):
+                    timeout = self.paused_until - time.monotonic()
+                    if timeout <= 0:
+                        timeout = 0 if self.bucket is None else self.bucket.take()
+                    if timeout <= 0:
+                        break
+                self.condition.wait(timeout)
+            heapq.heappop(self.queue)
+            self.in_flight += 1
+            # the next in line may be able to go too
+            self.condition.notify_all()
+        return time.monotonic() - t0, depth
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        # the server said to back off (429 + Retry-After): hold every request, not just this one
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
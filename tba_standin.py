@@ -0,0 +1,150 @@
+import argparse
+import gzip
+import hashlib
+import logging
+import math
+import random
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from tba_entities import TBAData, decompress_payload
+from tba_scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        config: StandinServer = self.server
+        with config.lock:
+            config.request_count += 1
+
+        delay = config.latency + random.uniform(-config.jitter, config.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if config.bucket is not None:
+            wait = config.bucket.take()
+            if wait > 0:
+                self.send_empty(429, {'Retry-After': str(math.ceil(wait))})
+                return
+
+        if config.error_rate > 0 and random.random() < config.error_rate:
+            self.send_empty(503)
+            return
+
+        body, etag = config.lookup(self.path)
+        if body is None:
+            self.send_empty(404)
+            return
+
+        headers = {
+            'ETag': etag,
+            'Cache-Control': f'public, max-age={config.max_age}',
+        }
+        if self.headers.get('If-None-Match') == etag:
+            self.send_empty(304, headers)
+            return
+
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 5)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(body))
+        self.send_response(200)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class StandinServer(ThreadingHTTPServer):
+    # serves /api/v3/... from a tba.db snapshot, with configurable latency, errors and rate limiting
+    daemon_threads = True
+
+    def __init__(self, db_file_name='tba.db', host='127.0.0.1', port=8080, latency=0.0, jitter=0.0,
+                 error_rate=0.0, rate_limit=None, burst=10, max_age=60):
+        super().__init__((host, port), StandinHandler)
+        self.engine = create_engine(f'sqlite:///{db_file_name}')
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bucket = None if rate_limit is None else TokenBucket(rate_limit, burst)
+        self.max_age = max_age
+        # handlers run on their own threads
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def lookup(self, url):
+        # (json bytes, etag), or (None, None) if the snapshot doesn't have it
+        with Session(self.engine) as session:
+            tba_data = session.get(TBAData, url)
+            if tba_data is None or tba_data.negative == '404':
+                return None, None
+            body = decompress_payload(tba_data.payload.data_json, tba_data.payload.compression)
+            etag = tba_data.etag
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if etag is None:
+            etag = 'W/"' + hashlib.sha1(body).hexdigest() + '"'
+        return body, etag
+
+    def start(self):
+        # serve from a daemon thread, for use inside benchmarks
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="tba.db snapshot to serve", default='tba.db')
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds of random latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 503")
+    parser.add_argument("--rate-limit", type=float, help="requests per second before answering 429")
+    parser.add_argument("--burst", type=int, default=10, help="requests allowed at once under --rate-limit")
+    parser.add_argument("--max-age", type=int, default=60, help="Cache-Control max-age to send")
+    args = parser.parse_args(argv)
+
+    logging.info ("invoked with %s", args)
+
+    server = StandinServer(db_file_name=args.db, host=args.host, port=args.port, latency=args.latency,
+                           jitter=args.jitter, error_rate=args.error_rate, rate_limit=args.rate_limit,
+                           burst=args.burst, max_age=args.max_age)
+    logging.info("serving %s at %s", args.db, server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,158 @@
+import collections
+import json
+import re
+import threading
+
+
+def url_pattern(url):
+    # /api/v3/team/frc3620/event/2025misjo/status -> /api/v3/team/{team}/event/{event}/status
+    parts = url.split('/')
+    for i, part in enumerate(parts):
+        if i > 0 and parts[i - 1] == 'district' and part != '':
+            parts[i] = '{district}'
+        elif re.fullmatch(r'frc\d+', part):
+            parts[i] = '{team}'
+        elif re.fullmatch(r'\d{4}[a-z][a-z0-9]*', part):
+            parts[i] = '{event}'
+        elif re.fullmatch(r'\d{4}', part):
+            parts[i] = '{year}'
+        elif re.fullmatch(r'\d+', part):
+            parts[i] = '{page}'
+    return '/'.join(parts)
+
+
+# upper bounds of the latency histogram buckets, in ms
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class LatencyHistogram:
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, ms):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def summary(self):
+        labels = [f'<={bound}' for bound in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}']
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count > 0 else 0.0,
+            'max_ms': round(self.max_ms, 3),
+            'buckets': {label: n for label, n in zip(labels, self.buckets) if n > 0},
+        }
+
+
+class FetchStats:
+    # where fetch() answers came from, and where the time went: http, sqlite, json decoding.
+    # http requests can be made from worker threads, so everything is updated under a lock.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = collections.Counter()
+        self.fetch_seconds = 0.0
+        self.statuses = collections.Counter()
+        # bytes as sent (possibly compressed), and after decoding
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self.http_seconds = 0.0
+        self.http_latency: dict[str, LatencyHistogram] = collections.defaultdict(LatencyHistogram)
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.decodes = 0
+        self.decode_seconds = 0.0
+        # request scheduler: time spent queued per priority class, and 429 back-offs
+        self.schedule_waits: dict[str, LatencyHistogram] = collections.defaultdict(LatencyHistogram)
+        self.max_queue_depth = 0
+        self.throttles = 0
+        self.throttle_seconds = 0.0
+
+    @property
+    def fetches(self):
+        return sum(self.sources.values())
+
+    def record_fetch(self, source, seconds):
+        with self.lock:
+            self.sources[source] += 1
+            self.fetch_seconds += seconds
+
+    def record_http(self, url, status_code, wire_bytes, content_bytes, seconds):
+        with self.lock:
+            self.statuses[str(status_code)] += 1
+            self.bytes_received += wire_bytes
+            self.bytes_decoded += content_bytes
+            self.http_seconds += seconds
+            self.http_latency[url_pattern(url)].add(seconds * 1000.0)
+
+    def record_sql(self, seconds):
+        with self.lock:
+            self.sql_statements += 1
+            self.sql_seconds += seconds
+
+    def record_schedule(self, priority_name, wait_seconds, queue_depth):
+        with self.lock:
+            self.schedule_waits[priority_name].add(wait_seconds * 1000.0)
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def record_throttle(self, seconds):
+        with self.lock:
+            self.throttles += 1
+            self.throttle_seconds += seconds
+
+    def record_decode(self, seconds):
+        with self.lock:
+            self.decodes += 1
+            self.decode_seconds += seconds
+
+    def summary(self):
+        with self.lock:
+            return {
+                'fetches': self.fetches,
+                'sources': dict(self.sources),
+                'fetch_seconds': round(self.fetch_seconds, 6),
+                'http': {
+                    'requests': sum(self.statuses.values()),
+                    'statuses': dict(self.statuses),
+                    'bytes_received': self.bytes_received,
+                    'bytes_decoded': self.bytes_decoded,
+                    'seconds': round(self.http_seconds, 6),
+                    'latency_by_pattern': {pattern: h.summary() for pattern, h in sorted(self.http_latency.items())},
+                },
+                'sqlite': {
+                    'statements': self.sql_statements,
+                    'seconds': round(self.sql_seconds, 6),
+                },
+                'json_decode': {
+                    'count': self.decodes,
+                    'seconds': round(self.decode_seconds, 6),
+                },
+                'scheduler': {
+                    'wait_by_priority': {name: h.summary() for name, h in sorted(self.schedule_waits.items())},
+                    'max_queue_depth': self.max_queue_depth,
+                    'throttles': self.throttles,
+                    'throttle_seconds': round(self.throttle_seconds, 3),
+                },
+            }
+
+    def line(self):
+        # one-line progress summary for the live log
+        with self.lock:
+            return (f"{self.fetches} fetches {dict(self.sources)}, "
+                    f"http {sum(self.statuses.values())} req {self.bytes_received} bytes "
+                    f"({self.bytes_decoded} decoded) {self.http_seconds:.2f}s, "
+                    f"sqlite {self.sql_statements} stmts {self.sql_seconds:.2f}s, "
+                    f"decode {self.decodes} {self.decode_seconds:.2f}s, "
+                    f"queue max {self.max_queue_depth}, throttled {self.throttles}")
+
+    def to_json(self):
+        return json.dumps(self.summary())
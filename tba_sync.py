@@ -0,0 +1,103 @@
+import argparse
+import datetime
+import logging
+import sys
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+import tba_cache
+from tba_entities import TBASyncProgress
+
+logger = logging.getLogger(__name__)
+
+
+def event_urls(event_key):
+    urls = tba_cache.TBAUrlCollector()
+    urls.get_event(event_key)
+    urls.get_teams_at_event(event_key)
+    urls.get_matches_for_event(event_key)
+    urls.get_team_statuses_at_event(event_key)
+    urls.get_event_awards(event_key)
+    urls.get_event_rankings(event_key)
+    return urls.urls
+
+
+def sync(tba: tba_cache.TBACache, year=None, district_key=None, max_concurrency=8, restart=False):
+    if district_key is not None:
+        sync_key = district_key
+        events = tba.get_district_events(district_key)
+    else:
+        sync_key = str(year)
+        events = tba.get_events_simple(year)
+    if events is None:
+        logger.warning("no events for %s", sync_key)
+        return
+
+    with Session(tba.engine) as session:
+        if restart:
+            session.execute(delete(TBASyncProgress).where(TBASyncProgress.sync_key == sync_key))
+            session.commit()
+        completed = set(session.scalars(
+            select(TBASyncProgress.event_key).where(TBASyncProgress.sync_key == sync_key)).all())
+    if len(completed) > 0:
+        logger.info("resuming sync of %s, %d of %d events already done", sync_key, len(completed), len(events))
+
+    media_done = set()
+    events = sorted(events, key=lambda e: (e.get('start_date') or '', e['key']))
+    for i, event in enumerate(events):
+        event_key = event['key']
+        if event_key in completed:
+            continue
+        logger.info("syncing %s (%d/%d)", event_key, i + 1, len(events))
+
+        failed = tba.prefetch_many(event_urls(event_key), max_concurrency=max_concurrency)
+
+        # team media is per team and year, so it is shared between events
+        team_keys = [team['key'] for team in tba.get_teams_at_event(event_key) or [] if team['key'] not in media_done]
+        urls = tba_cache.TBAUrlCollector()
+        for team_key in team_keys:
+            urls.get_team_media(team_key, event['year'])
+        failed.extend(tba.prefetch_many(urls.urls, max_concurrency=max_concurrency))
+        if len(failed) > 0:
+            # leave the event unchecked so a rerun picks it up again
+            raise RuntimeError(f"{len(failed)} urls failed for {event_key}, rerun to resume")
+        media_done.update(team_keys)
+
+        # checkpoint only after the event's rows are on disk
+        tba.flush()
+        with Session(tba.engine) as session:
+            session.merge(TBASyncProgress(sync_key=sync_key, event_key=event_key,
+                                          completed=datetime.datetime.now()))
+            session.commit()
+
+    # finished: the next sync of this key starts from the beginning again
+    with Session(tba.engine) as session:
+        session.execute(delete(TBASyncProgress).where(TBASyncProgress.sync_key == sync_key))
+        session.commit()
+    logger.info("sync of %s complete, %d events", sync_key, len(events))
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--year", type=int, help="sync every event in this season")
+    group.add_argument("--district", help="sync every event in this district, e.g. 2025fim")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--restart", action='store_true', help="ignore checkpoints from an interrupted sync")
+    parser.add_argument("--lazy", action='store_true', help="only go to internet if not in cache")
+    parser.add_argument("--rate-limit", type=float, help="max requests per second")
+    args = parser.parse_args(argv)
+
+    logging.info ("invoked with %s", args)
+
+    # a backfill: any interactive use of the same cache goes first
+    with tba_cache.TBACache(lazy=args.lazy, write_behind=True, normalize=True, rate_limit=args.rate_limit) as tba, \
+            tba.bulk():
+        sync(tba, year=args.year, district_key=args.district, max_concurrency=args.concurrency,
+             restart=args.restart)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
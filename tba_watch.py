@@ -0,0 +1,152 @@
+import argparse
+import datetime
+import json
+import logging
+import sys
+import time
+
+import requests
+
+import tba_cache
+
+logger = logging.getLogger(__name__)
+
+
+def watched_urls(event_key):
+    # kind -> url, for the event payloads that change while matches are played
+    return {
+        'matches': f'/api/v3/event/{event_key}/matches',
+        'rankings': f'/api/v3/event/{event_key}/rankings',
+        'statuses': f'/api/v3/event/{event_key}/teams/statuses',
+    }
+
+
+def keyed_items(kind, data):
+    # key -> item, so two versions of a payload can be compared item by item
+    if data is None:
+        return {}
+    if kind == 'matches':
+        return {match['key']: match for match in data}
+    if kind == 'rankings':
+        return {ranking['team_key']: ranking for ranking in data.get('rankings') or []}
+    return dict(data)
+
+
+class TBAWatcher:
+    # polls live event urls through the cache (so with ETags), quickly while an event is changing and
+    # backing off while it isn't. subscribers get one delta dict per changed url:
+    # {'event_key', 'kind', 'url', 'time', 'new': [keys], 'updated': [keys], 'removed': [keys]}
+
+    def __init__(self, tba: tba_cache.TBACache, event_keys, min_interval=15.0, max_interval=300.0,
+                 backoff=1.5, emit_initial=False):
+        self.tba = tba
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.emit_initial = emit_initial
+        self.subscribers = []
+        # per event: the current poll interval and when its urls are next due
+        self.events = {event_key: {'interval': min_interval, 'next_poll': 0.0} for event_key in event_keys}
+        # url -> keyed items of the last payload seen
+        self.snapshots = {}
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        return callback
+
+    def poll_event(self, event_key):
+        # returns the deltas for this event, and reschedules it
+        deltas = []
+        failed = False
+        for kind, url in watched_urls(event_key).items():
+            try:
+                data, source = self.tba.poll(url)
+            except requests.exceptions.RequestException as e:
+                logger.warning("polling %s failed: %s", url, e)
+                failed = True
+                continue
+            if source == 'missing':
+                continue
+            delta = self._delta(event_key, kind, url, keyed_items(kind, data))
+            if delta is not None:
+                deltas.append(delta)
+
+        # anything new means matches are being played: poll fast. otherwise slow down
+        state = self.events[event_key]
+        if len(deltas) > 0:
+            state['interval'] = self.min_interval
+        else:
+            state['interval'] = min(self.max_interval, state['interval'] * self.backoff)
+        if failed:
+            state['interval'] = max(state['interval'], self.min_interval * self.backoff)
+        state['next_poll'] = time.monotonic() + state['interval']
+        logger.debug("%s: %d deltas, next poll in %.0fs", event_key, len(deltas), state['interval'])
+        return deltas
+
+    def _delta(self, event_key, kind, url, items):
+        previous = self.snapshots.get(url, None)
+        self.snapshots[url] = items
+        if previous is None and not self.emit_initial:
+            return None
+        previous = previous or {}
+        new = sorted(key for key in items if key not in previous)
+        updated = sorted(key for key, item in items.items() if key in previous and previous[key] != item)
+        removed = sorted(key for key in previous if key not in items)
+        if len(new) == 0 and len(updated) == 0 and len(removed) == 0:
+            return None
+        return {
+            'event_key': event_key,
+            'kind': kind,
+            'url': url,
+            'time': datetime.datetime.now().astimezone().isoformat(),
+            'new': new,
+            'updated': updated,
+            'removed': removed,
+        }
+
+    def poll_due(self):
+        # polls every event that is due, and hands the deltas to the subscribers
+        deltas = []
+        now = time.monotonic()
+        for event_key, state in self.events.items():
+            if state['next_poll'] <= now:
+                deltas.extend(self.poll_event(event_key))
+        for delta in deltas:
+            for callback in self.subscribers:
+                callback(delta)
+        return deltas
+
+    def run(self, until=None):
+        # poll until interrupted, or until the time.monotonic() deadline `until`
+        while until is None or time.monotonic() < until:
+            self.poll_due()
+            next_poll = min(state['next_poll'] for state in self.events.values())
+            if until is not None:
+                next_poll = min(next_poll, until)
+            time.sleep(max(0.0, next_poll - time.monotonic()))
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--event", action='append', required=True, help="event key to watch (repeatable)")
+    parser.add_argument("--min-interval", type=float, default=15.0, help="seconds between polls while changing")
+    parser.add_argument("--max-interval", type=float, default=300.0, help="seconds between polls while idle")
+    parser.add_argument("--initial", action='store_true', help="report everything already there as new")
+    args = parser.parse_args(argv)
+
+    logging.info ("invoked with %s", args)
+
+    # deltas go to stdout as json lines, for piping into whatever reruns the analysis
+    with tba_cache.TBACache(normalize=True) as tba:
+        watcher = TBAWatcher(tba, args.event, min_interval=args.min_interval, max_interval=args.max_interval,
+                             emit_initial=args.initial)
+        watcher.subscribe(lambda delta: print(json.dumps(delta), flush=True))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
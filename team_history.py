@@ -1,4 +1,5 @@
 import argparse
+import concurrent.futures
 import json
 import logging
 import sys
@@ -30,6 +31,15 @@ def get_jsonpath_item (j : list[DatumInContext], default_value=None):
 def process(tba: tba_cache.TBACache, team_key=None):
     year_data = {}
     years = tba.get_team_years_participated(team_key=team_key)
+
+    # the cache can be shared by threads: look every year's events up in parallel, then each
+    # event's status and awards, so the walk below only hits memory
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        all_events = [event for events in executor.map(lambda y: tba.get_team_events(team_key=team_key, year=y), years)
+                      for event in events or []]
+        list(executor.map(lambda e: tba.get_team_status_at_event(team_key=team_key, event_key=e['key']), all_events))
+        list(executor.map(lambda e: tba.get_team_awards_at_event(team_key=team_key, event_key=e['key']), all_events))
+
     for year in years:
         this_year_data = {
             'year': year,
@@ -1,5 +1,4 @@
 import argparse
-import base64
 import json
 import logging
 import re
@@ -43,20 +42,8 @@ def main(argv):
                     our_matches.append ({'match': match['match_number'], 'alliance': team_keys, 'color': color})
                     break
 
-        for team_key in partners:
-            media_list = tba.get_team_media(team_key=team_key, year=year)
-            # jsonpath_ng does not like "$..[?(@.type=='avatar')]"
-            if media_list is not None:
-                for media in media_list:
-                    if media['type'] == 'avatar':
-                        fk = media['foreign_key']
-                        b64 = media.get('details', {}).get('base64Image', None)
-                        if b64 is not None:
-                            content = base64.b64decode(b64)
-                            fn = f"avatars/{fk}.png"
-                            team_dict[team_key]['avatar_fn'] = fn
-                            with open(fn, "wb") as f:
-                                f.write(content)
+        for team_key, fn in tba.export_avatars(partners, year).items():
+            team_dict[team_key]['avatar_fn'] = fn
 
         with open(args.event + '_xlights.json', 'w') as file:
             o = {
@@ -1,11 +1,11 @@
 import argparse
 import json
 import logging
-import os
 import re
 import sys
 
 import XLights
+import tba_avatars
 
 
 def main(argv):
@@ -17,6 +17,7 @@ def main(argv):
     args = parser.parse_args(argv)
 
     year = re.sub(r'^.*(\d{4}).*$', r'\1', args.event)
+    avatars = tba_avatars.read_manifest()
 
     with open(args.event + '_xlights.json', 'r') as file:
         o = json.load(file)
@@ -69,8 +70,8 @@ def main(argv):
 
         for team_number in args.teams:
             team_key = f"frc{team_number}"
-            avatar_filename = f"avatars/avatar_{year}_{team_key}.png"
-            if os.path.isfile(avatar_filename):
+            avatar_filename = tba_avatars.avatar_file(team_key, year, avatars)
+            if avatar_filename is not None:
                 e0 = XLights.MarqueeEffect()
                 e1 = XLights.PicturesEffect(Pictures_Filename=avatar_filename)
 